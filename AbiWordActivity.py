@@ -19,7 +19,8 @@
 from gettext import gettext as _
 import logging
 import os
-import json
+import shutil
+import hashlib
 
 # Abiword needs this to happen as soon as possible
 from gi.repository import GObject
@@ -30,12 +31,14 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('TelepathyGLib', '0.12')
 
 from gi.repository import Gtk
+from gi.repository import GLib
 from gi.repository import TelepathyGLib
 
 from sugar3.activity import activity
 from sugar3.activity.widgets import StopButton
 from sugar3.activity.widgets import ActivityToolbarButton
 from sugar3.activity.activity import get_bundle_path
+from sugar3.datastore import datastore
 
 from sugar3.graphics.toolbutton import ToolButton
 from sugar3.graphics.toolbarbox import ToolbarButton, ToolbarBox
@@ -45,7 +48,10 @@ from sugar3.graphics.xocolor import XoColor
 from sugar3.graphics.palettemenu import PaletteMenuBox
 from sugar3.graphics.palettemenu import PaletteMenuItem
 
-from sugarai_api import get_llm_response
+from sugarai_api import get_llm_response_async
+from sugarai_api import refresh_api_url
+from sugarai_api import dump_metrics_to_profile
+from prompt_registry import get_prompt
 import socket
 
 from toolbar import EditToolbar
@@ -57,6 +63,9 @@ from widgets import ExportButtonFactory
 from widgets import DocumentView
 from speechtoolbar import SpeechToolbar
 from chatbox import ChatSidebar
+from conversation_manager import deserialize_messages
+from conversation_log import ConversationLog
+from conversation_log import get_log_names, prune_logs
 from sugar3.graphics.objectchooser import ObjectChooser
 try:
     from sugar3.graphics.objectchooser import FILTER_TYPE_GENERIC_MIME
@@ -66,6 +75,22 @@ except:
 logger = logging.getLogger('write-activity')
 
 
+def _hash_file(path):
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _link_or_copy(source, destination):
+    # A hard link costs nothing, but needs both on the same file system
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
 class ConnectingBox(Gtk.VBox):
 
     def __init__(self):
@@ -103,26 +128,23 @@ class AbiWordActivity(activity.Activity):
         canvas_box.set_hexpand(True)
         canvas_box.set_homogeneous(False)
 
-        # Create sidebar
-        # Load conversation messages if available
-        initial_messages = None
-        if 'conversation' in self.metadata:
-            try:
-                initial_messages = json.loads(self.metadata['conversation'])
-            except (json.JSONDecodeError, TypeError) as e:
-                logger.debug(f"Error decoding conversation messages: {e}")
-                initial_messages = None
+        # File, revision and hash of the last save, see _save_document
+        self._last_saved = None
+        # Revision and PNG data of the last preview
+        self._preview = None
+
+        # The chat sidebar is created when the chat is first opened
+        self.chat_sidebar = None
+        self._conversation_log = None
+        # Look for orphaned conversation logs once the activity is up
+        GLib.idle_add(self._prune_conversation_logs)
 
-        self.chat_sidebar = ChatSidebar(self, initial_messages=initial_messages)
-        self.chat_sidebar.set_size_request(300, -1)  # Set width to 300px
-        
         content_box.pack_start(canvas_box, True, True, 0)
-        content_box.pack_end(self.chat_sidebar, False, True, 0)
+        self._content_box = content_box
 
         # Set the main content box as the canvas
         self.set_canvas(content_box)
         content_box.show_all()
-        self.chat_sidebar.hide() # Initially hide the chat sidebar
 
         self.activity_button = ActivityToolbarButton(self)
         toolbar_box.toolbar.insert(self.activity_button, -1)
@@ -263,11 +285,31 @@ class AbiWordActivity(activity.Activity):
         except OSError:
             return False
 
+    def _get_chat_sidebar(self):
+        """
+        The chat sidebar, built on first use. Most sessions never open
+        the chat, so its widgets, CSS and the saved conversation are only
+        loaded then.
+        """
+        if self.chat_sidebar is None:
+            # Load conversation messages if available
+            initial_messages = self._load_conversation()
+            self.chat_sidebar = ChatSidebar(
+                self, initial_messages=initial_messages)
+            self.chat_sidebar.set_size_request(300, -1)  # Set width to 300px
+            self._content_box.pack_end(self.chat_sidebar, False, True, 0)
+            self.chat_sidebar.show_all()
+            self.chat_sidebar.hide()
+        return self.chat_sidebar
+
     def _on_chat_button_clicked(self, widget):
-        if self.chat_sidebar.get_visible():
-            self.chat_sidebar.toggle_visibility()
+        chat_sidebar = self._get_chat_sidebar()
+        if chat_sidebar.get_visible():
+            chat_sidebar.toggle_visibility()
         else:
-            self.chat_sidebar.toggle_visibility()
+            chat_sidebar.toggle_visibility()
+            # resolve the Sugar-AI endpoint in the background, if needed
+            refresh_api_url()
             if not self.check_internet_connection():
                 self._show_no_internet_dialog()
 
@@ -314,21 +356,23 @@ class AbiWordActivity(activity.Activity):
         if not hasattr(self.abiword_canvas, 'render_page_to_image'):
             return activity.Activity.get_preview(self)
 
+        # Saves and exports share the preview of the same revision
+        revision = self.abiword_canvas.get_revision()
+        if self._preview is not None and self._preview[0] == revision and \
+                self.abiword_canvas.get_snapshots_enabled():
+            return self._preview[1]
+
         from gi.repository import GdkPixbuf
 
+        # AbiWord can only render a page at full size
         pixbuf = self.abiword_canvas.render_page_to_image(1)
         pixbuf = pixbuf.scale_simple(style.zoom(300), style.zoom(225),
                                      GdkPixbuf.InterpType.BILINEAR)
 
-        preview_data = []
-
-        def save_func(buf, length, data):
-            data.append(buf)
-            return True
-
-        pixbuf.save_to_callbackv(save_func, preview_data, 'png', [], [])
-        preview_data = b''.join(preview_data)
-
+        success, preview_data = pixbuf.save_to_bufferv('png', [], [])
+        if not success:
+            return None
+        self._preview = (revision, preview_data)
         return preview_data
 
     def _shared_cb(self, activity):
@@ -350,6 +394,9 @@ class AbiWordActivity(activity.Activity):
             logger.error('Failed to share or join activity')
             return
 
+        # buddies change the document without any local edit event
+        self.abiword_canvas.set_snapshots_enabled(False)
+
         self.conn = self.shared_activity.telepathy_conn
         self.tubes_chan = self.shared_activity.telepathy_tubes_chan
         self.text_chan = self.shared_activity.telepathy_text_chan
@@ -485,21 +532,22 @@ class AbiWordActivity(activity.Activity):
     def _buddy_left_cb(self, activity, buddy):
         logger.debug('buddy left with object path: %s', buddy.object_path())
         
-    def load_story_prompt(self):
-        prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "advice_prompt.txt")
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read()    
-        
-    def get_canvas_content_for_advice(self):
+    def get_document_text(self):
+        return self.abiword_canvas.get_content_snapshot('text/plain')
+
+    def get_canvas_content_for_advice(self, callback):
         """
         Retrieves the content from the abiword_canvas and sends it to the LLM.
+
+        The request runs in the background, callback is called with the
+        advice on the main loop. Returns the cancellable LLMRequest.
         """
         try:
-            document_content = self.abiword_canvas.get_content('text/plain', None)[0]
-            advice_prompt = self.load_story_prompt()
-            advice = get_llm_response([{"role": "user", "content": document_content}], advice_prompt)
-            self.chat_sidebar.set_advice_text(advice)
-            return advice
+            document_content = self.get_document_text()
+            advice_prompt = get_prompt('advice_prompt')
+            return get_llm_response_async(
+                [{"role": "user", "content": document_content}], callback,
+                advice_prompt)
 
         except Exception as e:
             logger.error("Error getting canvas content: %s", e)
@@ -522,7 +570,7 @@ class AbiWordActivity(activity.Activity):
         # if we were editing a text file save as plain text
         if self._is_plain_text(self.metadata['mime_type']):
             logger.debug('Writing file as type source (text/plain)')
-            self.abiword_canvas.save('file://' + file_path, 'text/plain', '')
+            self._save_document(file_path, 'text/plain')
         else:
             # if the file is new, save in .odt format
             if self.metadata['mime_type'] == '':
@@ -532,18 +580,135 @@ class AbiWordActivity(activity.Activity):
             if self.metadata['mime_type'] == 'application/msword':
                 self.metadata['mime_type'] = 'application/rtf'
 
-            self.abiword_canvas.save('file://' + file_path,
-                                     self.metadata['mime_type'], '')
+            self._save_document(file_path, self.metadata['mime_type'])
+
+        self.metadata['fulltext'] = \
+            self.abiword_canvas.get_content_snapshot('text/plain')[:3000]
 
-        self.metadata['fulltext'] = self.abiword_canvas.get_content(
-            'text/plain', None)[0][:3000]
+        # Save conversation messages to metadata; if the chat was never
+        # opened the saved conversation is left as it is
+        if self.chat_sidebar is not None:
+            self._save_conversation(self.chat_sidebar.context.messages)
 
-        # Save conversation messages to metadata
-        if hasattr(self, 'chat_sidebar') and hasattr(self.chat_sidebar, 'context') and hasattr(self.chat_sidebar.context, 'messages'):
+        # Keep the Sugar-AI request statistics of this session
+        dump_metrics_to_profile()
+
+    def _save_document(self, file_path, mime_type):
+        """
+        Save the document to file_path, or reuse the file of the last
+        save if the document has not changed since.
+
+        Reuse needs AbiWord to report the document as clean, the
+        revision alone can miss edits made without key or mouse events.
+        """
+        canvas = self.abiword_canvas
+        saved = self._last_saved
+        if saved is not None and canvas.get_snapshots_enabled() and \
+                canvas.is_known_clean() and \
+                saved['revision'] == canvas.get_revision() and \
+                saved['mime_type'] == mime_type:
+            try:
+                # make sure the kept file itself was not touched
+                if _hash_file(saved['path']) == saved['hash']:
+                    _link_or_copy(saved['path'], file_path)
+                    logger.debug('Document unchanged, reusing last save')
+                    return
+            except (IOError, OSError) as e:
+                logger.debug('Cannot reuse last save: %s', e)
+
+        canvas.save('file://' + file_path, mime_type, '')
+
+        # The datastore takes file_path away, keep our own link to it;
+        # only worth it if AbiWord will tell us about the next change
+        self._last_saved = None
+        if not canvas.is_known_clean():
+            return
+        kept_path = os.path.join(self.get_activity_root(), 'instance',
+                                 'last-save-' + self.get_id())
+        try:
+            if os.path.exists(kept_path):
+                os.unlink(kept_path)
+            _link_or_copy(file_path, kept_path)
+            self._last_saved = {'path': kept_path,
+                                'revision': canvas.get_revision(),
+                                'mime_type': mime_type,
+                                'hash': _hash_file(kept_path)}
+        except (IOError, OSError) as e:
+            logger.debug('Cannot keep last save: %s', e)
+
+    def _prune_conversation_logs(self):
+        """
+        Delete the conversation logs no Journal entry points to anymore,
+        so erased entries and forked logs do not pile up. The Journal is
+        queried asynchronously.
+        """
+        if get_log_names():
+            datastore.find({'activity': self.get_bundle_id()},
+                           properties=['conversation_log'],
+                           reply_handler=self.__find_logs_reply_cb,
+                           error_handler=self.__find_logs_error_cb)
+        return False
+
+    def __find_logs_reply_cb(self, entries, count):
+        # entries are the requested properties of each Journal entry
+        referenced = set()
+        if self._conversation_log is not None:
+            referenced.add(self._conversation_log.file_name)
+        for properties in entries:
+            pointer = properties.get('conversation_log')
+            if pointer:
+                try:
+                    referenced.add(
+                        ConversationLog.from_pointer(pointer).file_name)
+                except ValueError:
+                    pass
+        prune_logs(referenced)
+
+    def __find_logs_error_cb(self, error):
+        logger.debug('Cannot list Journal entries: %s', error)
+
+    def _load_conversation(self):
+        """
+        Messages of the chat saved with this entry, or None.
+
+        They are read from the conversation log the metadata points to,
+        entries saved by older versions keep the whole conversation in
+        the metadata instead.
+        """
+        if 'conversation_log' in self.metadata:
+            try:
+                log = ConversationLog.from_pointer(
+                    self.metadata['conversation_log'])
+                messages = log.read()
+                self._conversation_log = log
+                return messages
+            except (IOError, OSError, ValueError, TypeError) as e:
+                logger.debug(f"Error reading conversation log: {e}")
+
+        if 'conversation' in self.metadata:
             try:
-                self.metadata['conversation'] = json.dumps(self.chat_sidebar.context.messages)
-            except TypeError as e:
-                logger.debug(f"Error serializing conversation messages in write_file: {e}")
+                return deserialize_messages(self.metadata['conversation'])
+            except (ValueError, TypeError, KeyError) as e:
+                logger.debug(f"Error decoding conversation messages: {e}")
+        return None
+
+    def _save_conversation(self, messages):
+        """
+        Append the new messages to the conversation log and point the
+        metadata to it.
+
+        A conversation older versions kept in the metadata is left there,
+        copies of the entry on other machines still fall back to it.
+        """
+        if self._conversation_log is None:
+            self._conversation_log = ConversationLog(self.get_id() + '.jsonl')
+        try:
+            self._conversation_log.write(messages)
+        except (IOError, OSError, TypeError, KeyError) as e:
+            logger.debug(f"Error writing conversation log: {e}")
+            return
+        self.metadata['conversation_log'] = \
+            self._conversation_log.to_pointer()
 
     def _is_plain_text(self, mime_type):
         # These types have 'text/plain' in their mime_parents  but we need
@@ -17,38 +17,146 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from gettext import gettext as _
-from gi.repository import Gtk, Gdk, GObject
+import time
+from gi.repository import Gtk, Gdk, GObject, GLib, Pango
 from sugar3.graphics.icon import Icon
 from sugar3.graphics.toolbutton import ToolButton
 import os
 from sugar3.graphics import style
 from conversation_manager import ConversationContext
-from sugarai_api import load_story_prompt
-
-class ChatMessage(Gtk.Box):
-    def __init__(self, message, is_bot=True):
-        Gtk.Box.__init__(self, orientation=Gtk.Orientation.HORIZONTAL)
-        self.set_margin_top(5)
-        self.set_margin_bottom(5)
-        self.set_margin_start(10)
-        self.set_margin_end(10)
-
-        msg_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
-        msg_label = Gtk.Label(label=message)
-        msg_label.set_line_wrap(True)
-        msg_label.set_max_width_chars(30)
-        msg_label.set_justify(Gtk.Justification.LEFT)
-        
+from prompt_registry import get_prompt
+
+
+class ChatMessageList(Gtk.TreeView):
+    """
+    The chat messages, kept in a Gtk.ListStore.
+
+    All rows are drawn by one wrapping cell renderer instead of a widget
+    per message, and only the visible ones are drawn, so a long
+    conversation costs little more than a short one.
+    """
+    TEXT_COLUMN = 0
+    IS_BOT_COLUMN = 1
+    BOT_MESSAGE_COLOR = '#E5E5E5'
+    USER_MESSAGE_COLOR = '#FFE800'
+
+    def __init__(self):
+        self._store = Gtk.ListStore(str, bool)
+        Gtk.TreeView.__init__(self, model=self._store)
+        self.set_headers_visible(False)
+        self.set_enable_search(False)
+        self.set_grid_lines(Gtk.TreeViewGridLines.HORIZONTAL)
+        self.get_selection().set_mode(Gtk.SelectionMode.NONE)
+
+        self._renderer = Gtk.CellRendererText()
+        self._renderer.props.wrap_mode = Pango.WrapMode.WORD_CHAR
+        self._renderer.props.xpad = 10
+        self._renderer.props.ypad = 8
+        column = Gtk.TreeViewColumn()
+        column.pack_start(self._renderer, True)
+        column.set_cell_data_func(self._renderer, self.__cell_data_cb)
+        self.append_column(column)
+
+        self._wrap_width = 0
+        self.connect('size-allocate', self.__size_allocate_cb)
+
+    def __cell_data_cb(self, column, cell, model, tree_iter, data):
+        text, is_bot = model.get(tree_iter, self.TEXT_COLUMN,
+                                 self.IS_BOT_COLUMN)
+        cell.props.text = text
         if is_bot:
-            msg_box.get_style_context().add_class('bot-message')
-            self.pack_start(msg_box, True, True, 0)
+            cell.props.cell_background = self.BOT_MESSAGE_COLOR
+            cell.props.alignment = Pango.Alignment.LEFT
+        else:
+            cell.props.cell_background = self.USER_MESSAGE_COLOR
+            cell.props.alignment = Pango.Alignment.RIGHT
+
+    def __size_allocate_cb(self, widget, allocation):
+        wrap_width = allocation.width - 2 * self._renderer.props.xpad
+        if wrap_width > 0 and wrap_width != self._wrap_width:
+            self._wrap_width = wrap_width
+            self._renderer.props.wrap_width = wrap_width
+            # the row heights depend on the wrap width
+            self.get_column(0).queue_resize()
+
+    def add_message(self, message, is_bot=True):
+        """
+        Append a message, returns its Gtk.TreeIter.
+        """
+        return self._store.append((message, is_bot))
+
+    def remove_message(self, tree_iter):
+        self._store.remove(tree_iter)
+
+    def set_message_text(self, tree_iter, message):
+        self._store.set_value(tree_iter, self.TEXT_COLUMN, message)
+
+    def append_message_text(self, tree_iter, text):
+        self._store.set_value(
+            tree_iter, self.TEXT_COLUMN,
+            self._store.get_value(tree_iter, self.TEXT_COLUMN) + text)
+
+    def scroll_to_end(self):
+        n_rows = len(self._store)
+        if n_rows:
+            self.scroll_to_cell(Gtk.TreePath(n_rows - 1), None, False, 0, 0)
+
+
+class FrameworkRow(Gtk.Box):
+    """
+    A story field and its value in the framework view. The value shows
+    the meaning of the field while it is empty.
+    """
+
+    def __init__(self, key, default_meaning):
+        Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL,
+                         spacing=2)
+        self._default_meaning = default_meaning
+        self._value = None
+
+        key_label = Gtk.Label(label=key.capitalize()+':')
+        key_label.set_xalign(0)
+        key_label.get_style_context().add_class('framework-key')
+        value_frame = Gtk.Frame()
+        value_frame.set_shadow_type(Gtk.ShadowType.IN)
+        value_frame.get_style_context().add_class('framework-value-frame')
+        value_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+
+        self._value_label = Gtk.Label()
+        self._value_label.set_xalign(0.5)
+        self._value_label.set_justify(Gtk.Justification.CENTER)
+        self._value_label.set_halign(Gtk.Align.CENTER)
+        self._value_label.set_valign(Gtk.Align.CENTER)
+        value_box.pack_start(self._value_label, True, True, 10)
+        value_frame.add(value_box)
+        self.pack_start(key_label, False, False, 0)
+        self.pack_start(value_frame, False, False, 0)
+        self.set_value('')
+
+    def set_value(self, value):
+        if value == self._value:
+            return
+        self._value = value
+        style_context = self._value_label.get_style_context()
+        if value:
+            self._value_label.set_text(value)
+            style_context.remove_class('framework-default-value-label')
+            style_context.add_class('framework-value-label')
         else:
-            msg_box.get_style_context().add_class('user-message')
-            self.pack_end(msg_box, True, True, 0)
-            
-        msg_box.pack_start(msg_label, True, True, 0)
+            self._value_label.set_text(self._default_meaning or '')
+            style_context.remove_class('framework-value-label')
+            style_context.add_class('framework-default-value-label')
+
 
 class ChatSidebar(Gtk.Box):
+    # Refresh the story framework in the background once this many
+    # messages have not been analyzed yet
+    BACKGROUND_EXTRACT_MESSAGES = 4
+    # Seconds the chat has to be quiet before the background refresh
+    BACKGROUND_EXTRACT_DELAY = 5
+    # Minimum seconds between two background refreshes
+    BACKGROUND_EXTRACT_INTERVAL = 30
+
     def __init__(self, activity, initial_messages=None):
         # Load CSS
         css_provider = Gtk.CssProvider()
@@ -67,7 +175,20 @@ class ChatSidebar(Gtk.Box):
         if initial_messages:
             self.context.messages = initial_messages
 
-        self.system_prompt = load_story_prompt()
+        self._chat_request = None
+        self._framework_request = None
+        self._advice_request = None
+        self._compact_request = None
+        self._pending_message = None
+        self._pending_streamed = False
+        # Speculative framework extraction while chatting
+        self._background_request = None
+        self._background_source_id = None
+        self._background_started = 0
+        self._framework_displayed = False
+        # Framework view rows by story field, created on first display
+        self._framework_rows = {}
+        self._framework_separator = None
 
         self.default_meanings = {
             'title': _('The name of your story.'),
@@ -93,18 +214,19 @@ class ChatSidebar(Gtk.Box):
 
         # Header with Create Framework button
         header = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-        create_btn = Gtk.Button(label=_('Create framework'))
-        create_btn.get_style_context().add_class('create-framework-button')
-        create_btn.connect('clicked', self._create_framework)
-        header.pack_start(create_btn, True, False, 0)
+        self.create_btn = Gtk.Button(label=_('Create framework'))
+        self.create_btn.get_style_context().add_class(
+            'create-framework-button')
+        self.create_btn.connect('clicked', self._create_framework)
+        header.pack_start(self.create_btn, True, False, 0)
         self.chat_view_box.pack_start(header, False, True, 10)
 
         # Chat messages area
         scroll = Gtk.ScrolledWindow()
         scroll.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
 
-        self.messages_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
-        scroll.add(self.messages_box)
+        self.messages_list = ChatMessageList()
+        scroll.add(self.messages_list)
         self.chat_view_box.pack_start(scroll, True, True, 0)
 
         # Input area
@@ -113,11 +235,11 @@ class ChatSidebar(Gtk.Box):
         self.entry.set_placeholder_text(_('My story is about...'))
         self.entry.connect('activate', self._send_message)
 
-        send_btn = Gtk.Button(label=_('Send'))
-        send_btn.connect('clicked', self._send_message)
+        self.send_btn = Gtk.Button(label=_('Send'))
+        self.send_btn.connect('clicked', self._send_message)
 
         input_box.pack_start(self.entry, True, True, 5)
-        input_box.pack_start(send_btn, False, True, 5)
+        input_box.pack_start(self.send_btn, False, True, 5)
 
         self.chat_view_box.pack_end(input_box, False, True, 10)
         # Show initial bot message
@@ -213,6 +335,81 @@ class ChatSidebar(Gtk.Box):
         # Ensure advice section is hidden by default after all packing
         self.advice_section_box.hide()
 
+        self.connect('destroy', self.__destroy_cb)
+
+    def __destroy_cb(self, widget):
+        self.cancel_requests()
+
+    def cancel_requests(self):
+        """
+        Abort every in-flight LLM request started by the sidebar.
+        """
+        self._cancel_chat_request()
+        if self._framework_request is not None:
+            self._framework_request.cancel()
+            self._framework_request = None
+            self.create_btn.set_label(_('Create framework'))
+        if self._advice_request is not None:
+            self._advice_request.cancel()
+            self._advice_request = None
+            self.advice_label.set_text('')
+        self._cancel_background_extraction()
+        if self._compact_request is not None:
+            self._compact_request.cancel()
+            self._compact_request = None
+
+    def _cancel_chat_request(self):
+        if self._chat_request is None:
+            return
+        self._chat_request.cancel()
+        self._chat_request = None
+        self.messages_list.remove_message(self._pending_message)
+        self._pending_message = None
+
+    def _cancel_background_extraction(self):
+        if self._background_source_id is not None:
+            GLib.source_remove(self._background_source_id)
+            self._background_source_id = None
+        if self._background_request is not None:
+            self._background_request.cancel()
+            self._background_request = None
+
+    def _schedule_background_extraction(self):
+        """
+        Refresh the story framework once the chat has been quiet for a
+        while, so "Create framework" can show it right away.
+        """
+        if self._background_source_id is not None:
+            GLib.source_remove(self._background_source_id)
+            self._background_source_id = None
+        if self.context.get_unanalyzed_count() < \
+                self.BACKGROUND_EXTRACT_MESSAGES:
+            return
+        elapsed = time.monotonic() - self._background_started
+        delay = max(self.BACKGROUND_EXTRACT_DELAY,
+                    self.BACKGROUND_EXTRACT_INTERVAL - elapsed)
+        self._background_source_id = GLib.timeout_add_seconds(
+            int(delay) + 1, self._background_extraction_cb)
+
+    def _background_extraction_cb(self):
+        self._background_source_id = None
+        # Never compete with a request the child is waiting for; the next
+        # chat reply schedules the refresh again
+        if self._chat_request is not None or \
+                self._framework_request is not None or \
+                self._compact_request is not None or \
+                self._background_request is not None:
+            return False
+        self._background_started = time.monotonic()
+        self._background_request = self.context.update_story_info_async(
+            self._background_story_info_cb)
+        return False
+
+    def _background_story_info_cb(self, story_info):
+        self._background_request = None
+        if self.main_stack.get_visible_child_name() == 'framework_view':
+            self._update_framework_display()
+
     def _toggle_advice_section(self, widget):
         if self.advice_section_box.get_visible():
             self.advice_section_box.hide()
@@ -220,9 +417,18 @@ class ChatSidebar(Gtk.Box):
             self.advice_section_box.show()
 
     def _generate_and_display_advice(self, widget):
-        self.advice_label.set_text("Generating advice...")
-        advice = self.activity.get_canvas_content_for_advice()
-        self.advice_label.set_text(advice)
+        # A new click supersedes the advice still being generated
+        if self._advice_request is not None:
+            self._advice_request.cancel()
+        self.advice_label.set_text(_('Generating advice...'))
+        self._advice_request = self.activity.get_canvas_content_for_advice(
+            self._advice_cb)
+        if self._advice_request is None:
+            self.advice_label.set_text('')
+
+    def _advice_cb(self, advice):
+        self._advice_request = None
+        self.set_advice_text(advice)
 
     def set_advice_text(self, advice_text):
         self.advice_label.set_text(advice_text)
@@ -233,86 +439,150 @@ class ChatSidebar(Gtk.Box):
 
     def _send_message(self, widget):
         message = self.entry.get_text()
-        if message:
-            self.context.add_user_message(message)
-            self.add_message(message, False)
-            self.entry.set_text('')
-            # Get LLM response using the loaded system prompt
-            response = self.context.get_llm_response(self.context.get_latest_context(), self.system_prompt)
-            self.context.add_bot_message(response)
-            self.add_message(response, True)
+        if not message:
+            return
+        # A new message supersedes the reply still being generated
+        self._cancel_chat_request()
+        # The chat is not idle anymore
+        if self._background_source_id is not None:
+            GLib.source_remove(self._background_source_id)
+            self._background_source_id = None
+        self.context.add_user_message(message)
+        self.add_message(message, False)
+        self.entry.set_text('')
+        # Show a placeholder while the LLM answers on a worker thread,
+        # so the document canvas stays responsive
+        self._pending_message = self.add_message(
+            _('Mary Tales is thinking...'), True)
+        self._pending_streamed = False
+        self._chat_request = self.context.get_reply_stream_async(
+            self._chat_chunk_cb, self._chat_response_cb)
+
+    def _chat_chunk_cb(self, text):
+        # The first token replaces the placeholder, the rest are appended
+        if self._pending_streamed:
+            self.messages_list.append_message_text(self._pending_message,
+                                                   text)
+        else:
+            self.messages_list.set_message_text(self._pending_message, text)
+            self._pending_streamed = True
+        self._scroll_to_bottom()
+
+    def _chat_response_cb(self, response):
+        self._chat_request = None
+        self.context.add_bot_message(response)
+        self.messages_list.set_message_text(self._pending_message, response)
+        self._pending_message = None
+        self._scroll_to_bottom()
+        # Fold old turns into the summary now, the next turn just uses it
+        if self._compact_request is None:
+            self._compact_request = self.context.compact_history_async(
+                self._compact_cb)
+        self._schedule_background_extraction()
+
+    def _compact_cb(self):
+        self._compact_request = None
 
     def add_message(self, message, is_bot=True):
-        msg = ChatMessage(message, is_bot)
-        self.messages_box.pack_start(msg, False, True, 0)
-        msg.show_all()
+        tree_iter = self.messages_list.add_message(message, is_bot)
+        self._scroll_to_bottom()
+        return tree_iter
+
+    def _scroll_to_bottom(self):
         # Auto-scroll to new message
-        adj = self.messages_box.get_parent().get_vadjustment()
-        adj.set_value(adj.get_upper() - adj.get_page_size())
+        self.messages_list.scroll_to_end()
 
     def _create_framework(self, widget):
-        self.context.update_story_info()
-        self._update_framework_display() # Call a new method to update content
+        # A new request supersedes the stale one
+        if self._framework_request is not None:
+            self._framework_request.cancel()
+            self._framework_request = None
+        # and covers everything the background refresh would do
+        self._cancel_background_extraction()
+
+        # Show what is known right away, refresh it only if stale
+        self._framework_displayed = any(self.context.story_info.values())
+        if self._framework_displayed:
+            self._display_framework()
+        if not self.context.is_story_info_stale():
+            self.create_btn.set_label(_('Create framework'))
+            return
+
+        self.create_btn.set_label(_('Creating framework...'))
+        document_text = self.activity.get_document_text()
+        if document_text.strip():
+            # A single round trip fills both the framework and the advice
+            self._framework_request = self.context.analyze_story_async(
+                document_text, get_prompt('advice_prompt'),
+                self._analysis_cb)
+        else:
+            self._framework_request = self.context.update_story_info_async(
+                self._story_info_cb)
+
+    def _analysis_cb(self, analysis):
+        story_info, advice = analysis
+        if advice is not None:
+            if self._advice_request is not None:
+                self._advice_request.cancel()
+                self._advice_request = None
+            self.set_advice_text(advice)
+        self._story_info_cb(story_info)
+
+    def _story_info_cb(self, story_info):
+        self._framework_request = None
+        self.create_btn.set_label(_('Create framework'))
+        if self._framework_displayed:
+            # Already on screen, do not pull the child back to it
+            self._update_framework_display()
+        else:
+            self._display_framework()
+
+    def _display_framework(self):
+        self._update_framework_display()
         self.main_stack.set_visible_child_name("framework_view") # Switch to framework view
         self.advice_section_box.hide() # Ensure advice section is hidden by default when framework is created
 
-    def _create_framework_pair(self, key, value):
-        pair_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
-        key_label = Gtk.Label(label=key.capitalize()+':')
-        key_label.set_xalign(0)
-        key_label.get_style_context().add_class('framework-key')
-        value_frame = Gtk.Frame()
-        value_frame.set_shadow_type(Gtk.ShadowType.IN)
-        value_frame.get_style_context().add_class('framework-value-frame')
-        value_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-        if value:
-            value_label = Gtk.Label(label=value)
-            value_label.get_style_context().add_class('framework-value-label')
-        else:
-            value_label = Gtk.Label(label=self.default_meanings.get(key))
-            value_label.get_style_context().add_class('framework-default-value-label')
-
-        value_label.set_xalign(0.5)
-        value_label.set_justify(Gtk.Justification.CENTER)
-        value_label.set_halign(Gtk.Align.CENTER)
-        value_label.set_valign(Gtk.Align.CENTER)
-        value_box.pack_start(value_label, True, True, 10)
-        value_frame.add(value_box)
-        pair_box.pack_start(key_label, False, False, 0)
-        pair_box.pack_start(value_frame, False, False, 0)
-        return pair_box
+    def _create_framework_rows(self):
+        # One persistent row per story field, in their default order, and
+        # the separator between the filled and the empty ones
+        for key in self.context.story_info:
+            row = FrameworkRow(key, self.default_meanings.get(key))
+            self.framework_content_box.pack_start(row, False, False, 10)
+            self._framework_rows[key] = row
+        self._framework_separator = Gtk.Separator(
+            orientation=Gtk.Orientation.HORIZONTAL)
+        self._framework_separator.set_margin_top(10)
+        self._framework_separator.set_margin_bottom(10)
+        self.framework_content_box.pack_start(
+            self._framework_separator, False, False, 0)
+        self.framework_content_box.show_all()
 
     def _update_framework_display(self):
-        # Clear existing framework content
-        for child in self.framework_content_box.get_children():
-            self.framework_content_box.remove(child)
+        if not self._framework_rows:
+            self._create_framework_rows()
 
         # Separate keys with values from keys without values
         keys_with_values = []
         keys_without_values = []
         for key, value in self.context.story_info.items():
+            self._framework_rows[key].set_value(value)
             if value:
-                keys_with_values.append((key, value))
+                keys_with_values.append(key)
             else:
-                keys_without_values.append((key, value))
-
-        # Display keys with values first
-        for key, value in keys_with_values:
-            pair_box = self._create_framework_pair(key, value)
-            self.framework_content_box.pack_start(pair_box, False, False, 10)
-
-        # Add a separator after keys with values
-        if keys_with_values and keys_without_values:
-            separator = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
-            separator.set_margin_top(10)
-            separator.set_margin_bottom(10)
-            self.framework_content_box.pack_start(separator, False, False, 0)
-
-        # Then display keys without values
-        for key, value in keys_without_values:
-            pair_box = self._create_framework_pair(key, value)
-            self.framework_content_box.pack_start(pair_box, False, False, 10)
-        self.framework_content_box.show_all()
+                keys_without_values.append(key)
+
+        # Keys with values first, then the separator and keys without
+        # values; only the rows that moved are touched
+        children = [self._framework_rows[key] for key in keys_with_values]
+        children.append(self._framework_separator)
+        children.extend(self._framework_rows[key]
+                        for key in keys_without_values)
+        for position, child in enumerate(children):
+            if self.framework_content_box.child_get_property(
+                    child, 'position') != position:
+                self.framework_content_box.reorder_child(child, position)
+        self._framework_separator.set_visible(
+            bool(keys_with_values and keys_without_values))
 
     def _show_framework(self, widget=None):
         # This method is now primarily for the 'Back' button in the header
@@ -326,6 +596,7 @@ class ChatSidebar(Gtk.Box):
 
     def toggle_visibility(self):
         if self.get_visible():
+            self.cancel_requests()
             self.hide()
         else:
             self.show()
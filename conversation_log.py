@@ -0,0 +1,164 @@
+# Copyright (C) 2006 by Martin Sevior
+# Copyright (C) 2006-2007 Marc Maurer <uwog@uwog.net>
+# Copyright (C) 2007, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import json
+import time
+import uuid
+import logging
+
+from sugar3.activity.activity import get_activity_root
+
+from conversation_manager import ChatRecord
+
+logger = logging.getLogger('write-activity')
+
+
+# Logs younger than this are never pruned, their entry may not be saved
+# to the datastore yet
+PRUNE_MIN_AGE = 24 * 60 * 60
+
+
+def get_log_dir():
+    return os.path.join(get_activity_root(), 'data', 'conversations')
+
+
+def get_log_names():
+    """
+    Names of the conversation logs on disk.
+    """
+    try:
+        return [name for name in os.listdir(get_log_dir())
+                if name.endswith('.jsonl')]
+    except OSError:
+        return []
+
+
+def prune_logs(referenced):
+    """
+    Delete the conversation logs whose name is not in referenced, the
+    names Journal entries still point to, unless they were written
+    recently. Erasing an entry or forking its log leaves such files.
+    """
+    log_dir = get_log_dir()
+    now = time.time()
+    for name in get_log_names():
+        if name in referenced:
+            continue
+        path = os.path.join(log_dir, name)
+        try:
+            if now - os.path.getmtime(path) < PRUNE_MIN_AGE:
+                continue
+            os.unlink(path)
+            logger.debug('Pruned conversation log %s', name)
+        except OSError as e:
+            logger.debug('Cannot prune conversation log %s: %s', name, e)
+
+
+class ConversationLog(object):
+    """
+    Append-only transcript of a chat, one JSON [role, content] pair per
+    line, in the activity data directory.
+
+    The Journal entry only keeps a pointer to it: the file name and how
+    many bytes and messages it had when the entry was saved. Saving again
+    appends just the new messages. Resuming an older copy of the entry
+    finds the file longer than its pointer says; the log is then forked
+    into a new file so the copies do not overwrite each other.
+    """
+
+    def __init__(self, file_name, length=0, count=0):
+        self.file_name = file_name
+        self.length = length
+        self.count = count
+
+    @classmethod
+    def from_pointer(cls, pointer):
+        """
+        Log described by the metadata value written by to_pointer.
+        Raises ValueError if pointer cannot be decoded.
+        """
+        try:
+            data = json.loads(pointer)
+            return cls(os.path.basename(data['file']), int(data['length']),
+                       int(data['count']))
+        except (TypeError, KeyError) as e:
+            raise ValueError(f"Invalid conversation log pointer: {e}")
+
+    def to_pointer(self):
+        return json.dumps({'file': self.file_name, 'length': self.length,
+                           'count': self.count})
+
+    def get_path(self):
+        return os.path.join(get_log_dir(), self.file_name)
+
+    def read(self):
+        """
+        List of ChatRecord up to the pointer. Raises IOError if the file
+        is missing or shorter than expected, ValueError if it is corrupt.
+        """
+        with open(self.get_path(), 'rb') as f:
+            data = f.read(self.length)
+        if len(data) != self.length:
+            raise IOError(f"{self.file_name} is truncated")
+        messages = []
+        for line in data.decode('utf-8').splitlines():
+            role, content = json.loads(line)
+            messages.append(ChatRecord(role, content))
+        if len(messages) != self.count:
+            raise ValueError(f"{self.file_name} does not match its pointer")
+        return messages
+
+    def _fork(self):
+        base_name = self.file_name.rsplit('.', 1)[0].split('-')[0]
+        self.file_name = f"{base_name}-{uuid.uuid4().hex[:8]}.jsonl"
+        logger.debug('Forking conversation log to %s', self.file_name)
+
+    def write(self, messages):
+        """
+        Bring the log up to date with messages, appending only those not
+        written yet, and advance the pointer.
+        """
+        os.makedirs(get_log_dir(), exist_ok=True)
+        try:
+            size = os.path.getsize(self.get_path())
+        except OSError:
+            size = None
+
+        if size == self.length and self.count <= len(messages):
+            new_messages = messages[self.count:]
+            mode = 'ab'
+        else:
+            # Another copy of the entry wrote to the file after our
+            # pointer, or it is gone: start over with everything
+            if size is not None:
+                self._fork()
+            new_messages = messages
+            mode = 'wb'
+            self.length = self.count = 0
+
+        data = b''.join(
+            json.dumps([msg["role"], msg["content"]],
+                       ensure_ascii=False).encode('utf-8') + b'\n'
+            for msg in new_messages)
+        with open(self.get_path(), mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.length += len(data)
+        self.count += len(new_messages)
@@ -18,85 +18,476 @@
 
 import json
 import os
+import re
+import sys
+import logging
 from sugarai_api import get_llm_response, get_llm_response_framework
+from sugarai_api import get_llm_response_stream
+from sugarai_api import LLMRequest
+from sugarai_api import is_error_response
+from prompt_registry import get_prompt, render_prompt
 
-# Extract story info from conversation using LLM analysis prompt
-def extract_story_info(messages):
-    analysis_prompt = (
-        "Analyze this conversation and extract key story elements.\n"
-        "Return ONLY a valid JSON object with these exact fields (leave empty string if not mentioned):\n"
-        "{\n"
-        "    \"title\": \"\",\n"
-        "    \"setting\": \"\",\n"
-        "    \"main_character\": \"\",\n"
-        "    \"side_character\": \"\",\n"
-        "    \"goal\": \"\",\n"
-        "    \"conflict\": \"\",\n"
-        "    \"climax\": \"\",\n"
-        "    \"helpers\": \"\",\n"
-        "    \"villains\": \"\",\n"
-        "    \"ending\": \"\",\n"
-        "    \"theme\": \"\"\n"
-        "}\n"
-        "Do not include any other text or explanation, just the JSON object."
-    )
-    analysis = get_llm_response_framework(messages, analysis_prompt)
+logger = logging.getLogger('write-activity')
+
+
+class ChatRecord(object):
+    """
+    A single chat message.
+
+    Much smaller than a dict per message, and the role strings are
+    interned so a long conversation keeps a single copy of each. Supports
+    msg["role"] and msg["content"] like the message dicts it replaces.
+    """
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        return isinstance(other, ChatRecord) and \
+            self.role == other.role and self.content == other.content
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+def as_dicts(messages):
+    """
+    Plain message dicts, as sent to the LLM, for records or dicts.
+    """
+    return [msg.to_dict() if isinstance(msg, ChatRecord) else msg
+            for msg in messages]
+
+
+def deserialize_messages(text):
+    """
+    List of ChatRecord from a conversation stored in the Journal
+    metadata by older versions, a plain JSON list of message dicts.
+
+    Raises ValueError if text is not such a list.
+    """
+    messages = json.loads(text)
+    if not isinstance(messages, list):
+        raise ValueError("Conversation is not a list")
+    return [ChatRecord(msg["role"], msg["content"]) for msg in messages]
+
+
+# Rough number of characters per token, good enough for budgeting
+CHARS_PER_TOKEN = 4
+# Per message overhead of the chat template, in tokens
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def estimate_tokens(messages):
+    """
+    Cheap estimate of the number of tokens a message list will use.
+    """
+    return sum(len(msg["content"]) // CHARS_PER_TOKEN
+               for msg in messages) + MESSAGE_TOKEN_OVERHEAD * len(messages)
+
+
+def summarize_conversation(messages, previous_summary=""):
+    """
+    Fold messages (and an earlier summary) into a short summary.
+
+    Returns None if the LLM call failed.
+    """
+    summary_prompt = get_prompt("conversation_summary_prompt")
+    if previous_summary:
+        messages = [{"role": "assistant",
+                     "content": "Summary so far: " + previous_summary}] + \
+            list(messages)
+    summary = get_llm_response_framework(
+        as_dicts(messages), summary_prompt,
+        validate=lambda answer: bool(answer.strip()))
+    if is_error_response(summary):
+        logger.debug("Could not summarize conversation: %s", summary)
+        return None
+    return summary.strip()
+
+
+# Fields of the story framework, in display order
+STORY_FIELDS = ("title", "setting", "main_character", "side_character",
+                "goal", "conflict", "climax", "helpers", "villains",
+                "ending", "theme")
+
+
+def empty_story_info():
+    return dict((field, "") for field in STORY_FIELDS)
+
+
+def merge_story_info(story_info, update):
+    """
+    Copy of story_info with the non-empty string fields of update applied.
+    """
+    merged = dict(story_info)
+    for field in STORY_FIELDS:
+        value = update.get(field)
+        if isinstance(value, str) and value.strip():
+            merged[field] = value
+    return merged
+
+
+def _with_story_info(messages, story_info):
+    # The framework found so far stands in for the messages it came from
+    if story_info is None or not any(story_info.values()):
+        return as_dicts(messages)
+    framework = "Story framework so far: " + json.dumps(story_info)
+    return [{"role": "assistant", "content": framework}] + as_dicts(messages)
+
+
+def _parse_json_object(answer):
+    start_idx = answer.find('{')
+    end_idx = answer.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        return None
     try:
-        start_idx = analysis.find('{')
-        end_idx = analysis.rfind('}') + 1
-        if start_idx != -1 and end_idx != -1:
-            json_str = analysis[start_idx:end_idx]
-            story_data = json.loads(json_str)
-            return story_data
-    except Exception:
-        pass
-    # Return default structure if parsing fails
-    return {
-        "title": "",
-        "setting": "",
-        "main_character": "",
-        "side_character": "",
-        "goal": "",
-        "conflict": "",
-        "climax": "",
-        "helpers": "",
-        "villains": "",
-        "ending": "",
-        "theme": ""
-    }
+        data = json.loads(answer[start_idx:end_idx])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _coerce_field(value):
+    if isinstance(value, str):
+        return value
+    # "helpers": ["owl", "fox"] is common enough to accept
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return ", ".join(v for v in value if v.strip())
+    return None
+
+
+def _search_string_field(answer, field):
+    # A well-formed "field": "value" pair anywhere in a broken answer
+    match = re.search(r'"%s"\s*:\s*("(?:[^"\\]|\\.)*")' % field, answer)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+
+def parse_story_fields(answer, framework=None):
+    """
+    Story fields found in an LLM answer, checked against STORY_FIELDS.
+
+    framework is the already decoded JSON object, if the answer could be
+    decoded at all. Fields it lacks or has in the wrong shape are looked
+    for in the raw answer. Returns a (fields, missing) tuple: a dict of
+    the fields with a usable value and the names of the others.
+    """
+    fields = {}
+    for field in STORY_FIELDS:
+        value = None
+        if framework is not None:
+            value = _coerce_field(framework.get(field))
+        if value is None:
+            value = _search_string_field(answer, field)
+        if value is not None:
+            fields[field] = value
+    missing = [field for field in STORY_FIELDS if field not in fields]
+    return fields, missing
+
+
+def _has_story_fields(answer, wanted, framework=None):
+    # Whether every field in wanted can be parsed from answer, the test
+    # an answer has to pass to be cached
+    fields, _ = parse_story_fields(answer, framework)
+    return all(field in fields for field in wanted)
+
+
+def _parse_analysis(analysis):
+    # The framework object and advice text of a story analysis answer,
+    # either may be None
+    data = _parse_json_object(analysis)
+    framework = advice = None
+    if data is not None:
+        framework = data.get("framework")
+        if not isinstance(framework, dict):
+            framework = None
+        advice = data.get("advice")
+    if not isinstance(advice, str):
+        advice = _search_string_field(analysis, "advice")
+    if advice is not None and not advice.strip():
+        advice = None
+    return framework, advice
+
+
+def _is_complete_analysis(analysis):
+    framework, advice = _parse_analysis(analysis)
+    return advice is not None and \
+        _has_story_fields(analysis, STORY_FIELDS, framework)
+
+
+def _story_schema(fields, indent=0):
+    # Empty JSON object with fields, for the $schema of the prompts
+    pad = " " * indent
+    lines = ",\n".join(f"{pad}    \"{field}\": \"\"" for field in fields)
+    return "{\n" + lines + "\n" + pad + "}"
+
+
+def _complete_story_fields(messages, fields, missing):
+    """
+    Ask again for the missing fields only, adding those found to fields.
+    """
+    logger.debug("Asking again for story fields %s", missing)
+    prompt = render_prompt("story_fields_prompt",
+                           schema=_story_schema(missing))
+    answer = get_llm_response_framework(
+        messages, prompt,
+        validate=lambda answer: _has_story_fields(
+            answer, missing, _parse_json_object(answer)))
+    if is_error_response(answer):
+        return
+    found, _ = parse_story_fields(answer, _parse_json_object(answer))
+    for field in missing:
+        if field in found:
+            fields[field] = found[field]
+
+
+# Extract story info from conversation using LLM analysis prompt
+def extract_story_info(messages, story_info=None):
+    """
+    Extract the story framework from messages.
+
+    If story_info is given only the messages added since it was extracted
+    need to be passed; the fields found in them are merged into a copy of
+    story_info. Fields missing from a malformed answer are asked for again
+    in a smaller request, those still missing keep their previous value.
+    Returns None if the answer cannot be used at all.
+    """
+    analysis_prompt = render_prompt("story_extraction_prompt",
+                                    schema=_story_schema(STORY_FIELDS))
+    messages = _with_story_info(messages, story_info)
+    analysis = get_llm_response_framework(
+        messages, analysis_prompt,
+        validate=lambda answer: _has_story_fields(
+            answer, STORY_FIELDS, _parse_json_object(answer)))
+    if is_error_response(analysis):
+        logger.debug("Could not extract story info: %s", analysis)
+        return None
+    fields, missing = parse_story_fields(analysis,
+                                         _parse_json_object(analysis))
+    if missing:
+        _complete_story_fields(messages, fields, missing)
+    if not fields:
+        logger.debug("Could not extract story info: %s", analysis)
+        return None
+    return merge_story_info(story_info or empty_story_info(), fields)
+
+
+def analyze_story(messages, document_text, advice_prompt, story_info=None):
+    """
+    Extract the story framework from the conversation and advice on the
+    document in a single request. story_info and malformed answers are
+    handled as in extract_story_info.
+
+    Returns a (story_info, advice) tuple, or None when the answer cannot
+    be used.
+    """
+    analysis_prompt = render_prompt(
+        "story_analysis_prompt", schema=_story_schema(STORY_FIELDS, 4),
+        advice_instructions=advice_prompt.strip())
+    conversation = _with_story_info(messages, story_info)
+    messages = conversation + [{"role": "document", "content": document_text}]
+    analysis = get_llm_response_framework(
+        messages, analysis_prompt, validate=_is_complete_analysis)
+    if is_error_response(analysis):
+        logger.debug("Could not analyze story: %s", analysis)
+        return None
+    framework, advice = _parse_analysis(analysis)
+
+    fields, missing = parse_story_fields(analysis, framework)
+    if missing:
+        # the advice does not depend on these, leave the document out
+        _complete_story_fields(conversation, fields, missing)
+    if not fields and advice is None:
+        logger.debug("Could not analyze story: %s", analysis)
+        return None
+    return merge_story_info(story_info or empty_story_info(), fields), \
+        advice
 
 # In-memory conversation context
 class ConversationContext:
+    # Messages kept verbatim, older ones are folded into a summary
+    KEEP_MESSAGES = 8
+    # Fold only once this many extra messages have piled up, so the
+    # summary is not recomputed on every turn
+    COMPACT_STEP = 6
+    # History beyond this many tokens is folded right away, keeping
+    # fewer than KEEP_MESSAGES if they are long
+    CONTEXT_TOKEN_BUDGET = 1500
+
     def __init__(self):
         self.messages = [
-            {"role": "assistant", "content": "Hi there!👋I am Mary Tales. Who is this story about?✨"}
+            ChatRecord("assistant", "Hi there!👋I am Mary Tales. Who is this story about?✨")
         ]
-        self.story_info = {
-            "title": "",
-            "setting": "",
-            "main_character": "",
-            "side_character": "",
-            "goal": "",
-            "conflict": "",
-            "climax": "",
-            "helpers": "",
-            "villains": "",
-            "ending": "",
-            "theme": ""
-        }
+        self.story_info = empty_story_info()
+        # Summary of self.messages[:self.summary_upto]
+        self.summary = ""
+        self.summary_upto = 0
+        # story_info was extracted from self.messages[:self.story_info_upto]
+        self.story_info_upto = 0
 
     def add_user_message(self, content):
-        self.messages.append({"role": "user", "content": content})
+        self.messages.append(ChatRecord("user", content))
 
     def add_bot_message(self, content):
-        self.messages.append({"role": "assistant", "content": content})
+        self.messages.append(ChatRecord("assistant", content))
 
     def get_latest_context(self):
-        return self.messages
+        """
+        Messages to send for the next chat turn: the summary of older
+        turns followed by every message it does not cover.
+
+        compact_history_async() folds messages into the summary once they
+        no longer fit in CONTEXT_TOKEN_BUDGET, so the request size stays
+        bounded however long the conversation gets. Until it has, a
+        request may go over the budget; no message is ever dropped.
+        """
+        prefix = []
+        if self.summary:
+            summary = "Summary of our story so far: " + self.summary
+            prefix = [{"role": "assistant", "content": summary}]
+        return prefix + as_dicts(self.messages[self.summary_upto:])
+
+    def _get_fold_upto(self):
+        # End of the messages to fold into the summary, or None if they
+        # still fit in the budget and not enough of them have accumulated
+        messages = self.messages
+        budget = self.CONTEXT_TOKEN_BUDGET - \
+            len(self.summary) // CHARS_PER_TOKEN
+        if estimate_tokens(messages[self.summary_upto:]) > budget:
+            # keep the latest messages that fit in half the budget, so
+            # the next turns do not need folding again
+            budget = self.CONTEXT_TOKEN_BUDGET // 2
+            fold_upto = len(messages)
+            while fold_upto > self.summary_upto + 1:
+                budget -= estimate_tokens([messages[fold_upto - 1]])
+                if budget < 0:
+                    break
+                fold_upto -= 1
+            # the latest message is always kept verbatim
+            fold_upto = min(fold_upto, len(messages) - 1)
+        else:
+            fold_upto = len(messages) - self.KEEP_MESSAGES
+            if fold_upto - self.summary_upto < self.COMPACT_STEP:
+                return None
+        if fold_upto <= self.summary_upto:
+            return None
+        return fold_upto
+
+    def compact_history_async(self, callback=None):
+        """
+        Fold old turns into the rolling summary on a worker thread once
+        they go over the budget or enough of them have accumulated. Meant
+        to run after a reply was delivered so no chat turn waits for it.
+        Returns the LLMRequest, or None if there is nothing to fold yet.
+        callback, if given, is called on the main loop when done.
+        """
+        fold_upto = self._get_fold_upto()
+        if fold_upto is None:
+            return None
+        summary_upto = self.summary_upto
+
+        def summary_cb(summary):
+            # a failed request leaves the history as it is, the next
+            # reply tries again
+            if summary is not None and not is_error_response(summary) and \
+                    self.summary_upto == summary_upto:
+                self.summary, self.summary_upto = summary, fold_upto
+            if callback is not None:
+                callback()
+
+        return LLMRequest(summarize_conversation,
+                          (self.messages[summary_upto:fold_upto],
+                           self.summary),
+                          summary_cb).start()
 
     def get_llm_response(self, messages, system_prompt=None):
-        return get_llm_response(messages, system_prompt)
+        # chat turns are sampled, never answer them from the cache
+        return get_llm_response(as_dicts(messages), system_prompt,
+                                use_cache=False)
+
+    def get_reply_stream_async(self, chunk_callback, callback,
+                               system_prompt=None):
+        """
+        Stream the assistant reply to the conversation so far, with the
+        older turns replaced by the current summary. Both callbacks run
+        on the main loop.
+        """
+        return LLMRequest(get_llm_response_stream,
+                          (self.get_latest_context(), system_prompt),
+                          callback, chunk_callback).start()
+
+    def get_unanalyzed_count(self):
+        """
+        Number of messages added since story_info was last extracted.
+        """
+        return len(self.messages) - self.story_info_upto
+
+    def is_story_info_stale(self):
+        return self.get_unanalyzed_count() > 0
+
+    def _new_messages(self):
+        # Messages the story info has not been extracted from yet, and
+        # the story info to merge their fields into
+        messages = self.messages[self.story_info_upto:]
+        story_info = self.story_info if self.story_info_upto else None
+        return messages, story_info
+
+    def _extract_story_info(self, messages, story_info):
+        if story_info is not None and not messages:
+            return story_info
+        return extract_story_info(messages, story_info)
 
     def update_story_info(self):
-        self.story_info = extract_story_info(self.messages)
-  
\ No newline at end of file
+        upto = len(self.messages)
+        story_info = self._extract_story_info(*self._new_messages())
+        if story_info is not None:
+            self.story_info, self.story_info_upto = story_info, upto
+
+    def update_story_info_async(self, callback):
+        """
+        Non-blocking variant of update_story_info; callback is called on
+        the main loop with the new story info. Returns the LLMRequest.
+        """
+        upto = len(self.messages)
+
+        def story_info_cb(story_info):
+            if isinstance(story_info, dict):
+                self.story_info, self.story_info_upto = story_info, upto
+            callback(self.story_info)
+
+        return LLMRequest(self._extract_story_info, self._new_messages(),
+                          story_info_cb).start()
+
+    def analyze_story_async(self, document_text, advice_prompt, callback):
+        """
+        Update the story info and get advice on document_text in a single
+        request. callback is called on the main loop with the
+        (story_info, advice) tuple. Returns the LLMRequest.
+        """
+        upto = len(self.messages)
+        messages, story_info = self._new_messages()
+
+        def analysis_cb(analysis):
+            advice = None
+            # analysis is an error string or None if the request failed,
+            # the previous framework is kept then
+            if isinstance(analysis, tuple):
+                story_info, advice = analysis
+                self.story_info, self.story_info_upto = story_info, upto
+            callback((self.story_info, advice))
+
+        return LLMRequest(analyze_story,
+                          (messages, document_text, advice_prompt,
+                           story_info),
+                          analysis_cb).start()
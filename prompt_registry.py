@@ -0,0 +1,143 @@
+# Copyright (C) 2006 by Martin Sevior
+# Copyright (C) 2006-2007 Marc Maurer <uwog@uwog.net>
+# Copyright (C) 2007, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import string
+import logging
+import threading
+
+logger = logging.getLogger('write-activity')
+
+PROMPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'prompts')
+
+
+def get_languages():
+    """
+    Languages to look for prompt variants in, most preferred first,
+    following the same environment variables as gettext.
+    """
+    for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
+        value = os.environ.get(envar)
+        if value:
+            break
+    else:
+        return []
+
+    languages = []
+    for lang in value.split(':'):
+        # es_ES.UTF-8@euro -> es_ES, es
+        lang = lang.split('.')[0].split('@')[0]
+        if not lang or lang in ('C', 'POSIX'):
+            continue
+        for candidate in (lang, lang.split('_')[0]):
+            if candidate not in languages:
+                languages.append(candidate)
+    return languages
+
+
+class PromptRegistry(object):
+    """
+    Prompt templates from the prompts directory.
+
+    A template is read from disk once and then served from memory; its
+    mtime is checked at most every CHECK_INTERVAL seconds so edited
+    prompts are picked up without restarting the activity. A locale
+    variant <name>.<lang>.txt is preferred over <name>.txt.
+    """
+
+    CHECK_INTERVAL = 2
+
+    def __init__(self, path=PROMPTS_PATH, languages=None):
+        self._path = path
+        self._languages = get_languages() if languages is None \
+            else languages
+        self._lock = threading.Lock()
+        # name -> [file_path, mtime, text, last_check]
+        self._entries = {}
+
+    def _find_file(self, name):
+        for lang in self._languages:
+            file_path = os.path.join(self._path, '%s.%s.txt' % (name, lang))
+            if os.path.exists(file_path):
+                return file_path
+        return os.path.join(self._path, name + '.txt')
+
+    def _load(self, name):
+        file_path = self._find_file(name)
+        mtime = os.stat(file_path).st_mtime
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        logger.debug('Loaded prompt %s from %s', name, file_path)
+        return [file_path, mtime, text, time.monotonic()]
+
+    def get(self, name):
+        """
+        Text of the prompt template called name. Raises IOError if there
+        is no such template.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and now - entry[3] < self.CHECK_INTERVAL:
+                return entry[2]
+            if entry is not None:
+                entry[3] = now
+                try:
+                    changed = os.stat(entry[0]).st_mtime != entry[1] or \
+                        self._find_file(name) != entry[0]
+                except OSError:
+                    changed = True
+                if not changed:
+                    return entry[2]
+            try:
+                self._entries[name] = self._load(name)
+            except (IOError, OSError):
+                if entry is None:
+                    raise
+                # keep serving the last good version
+                logger.warning('Could not reload prompt %s', name)
+            return self._entries[name][2]
+
+    def render(self, name, **values):
+        """
+        Prompt template called name with its $placeholders replaced by
+        values.
+        """
+        return string.Template(self.get(name)).safe_substitute(values)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_prompt_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry()
+        return _registry
+
+
+def get_prompt(name):
+    return get_prompt_registry().get(name)
+
+
+def render_prompt(name, **values):
+    return get_prompt_registry().render(name, **values)
@@ -70,8 +70,8 @@ class SpeechToolbar(Gtk.Toolbar):
     def _play_clicked_cb(self, widget):
         if not self._speech.get_is_paused():
             abi = self._activity.abiword_canvas
-            text = abi.get_content("text/plain", None)
-            self._speech.say_text(text[0])
+            text = abi.get_content_snapshot('text/plain')
+            self._speech.say_text(text)
         else:
             self._speech.restart()
 
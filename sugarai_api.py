@@ -17,85 +17,1071 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import json
+import time
+import uuid
+import gzip
+import hashlib
+import collections
+import random
+import threading
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from gi.repository import GLib
+from sugar3.activity.activity import get_activity_root
+from prompt_registry import get_prompt
+
+logger = logging.getLogger('write-activity')
 
 # Load environment variables
 load_dotenv(override=True)
 api_key = os.getenv("SUGAR_AI_API_KEY")
 sugar_ai_url = "https://ai.sugarlabs.org"
 local_url = "http://localhost:8000"
+# Set to skip endpoint probing, e.g. to use a local stand-in server
+url_override = os.getenv("SUGAR_AI_URL")
+
+# Failed calls answer with this prefix instead of raising
+ERROR_PREFIX = "Sorry, I encountered an error"
+
+
+def is_error_response(text):
+    return text.startswith(ERROR_PREFIX)
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+# Cancellation event of the LLMRequest running on the current thread
+_request_local = threading.local()
+
+
+def _get_cancel_event():
+    return getattr(_request_local, "cancel_event", None)
+
+
+def check_cancelled():
+    """
+    Raise RequestCancelled if the LLMRequest running on this thread has
+    been cancelled.
+    """
+    cancel_event = _get_cancel_event()
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelled()
+
+
+def _sleep(delay):
+    # a cancelled request wakes up immediately
+    cancel_event = _get_cancel_event()
+    if cancel_event is None:
+        time.sleep(delay)
+    else:
+        cancel_event.wait(delay)
+    check_cancelled()
+
+
+# Endpoint selection is lazy: nothing touches the network at import time.
+# Every server has a circuit breaker and a health score fed by the real
+# requests. Requests go to the healthiest server while the others are
+# probed in the background. The preferred server is remembered in the
+# activity profile and re-probed once that is older than
+# ENDPOINT_CACHE_TTL seconds.
+ENDPOINT_CACHE_TTL = 6 * 60 * 60
+ENDPOINT_CACHE_FILE = "sugarai-endpoint.json"
 
-def load_url():
+
+def _get_data_path(name):
+    """
+    Path of a file in the activity data directory, or None when running
+    outside of Sugar.
+    """
+    try:
+        data_path = os.path.join(get_activity_root(), "data")
+    except (KeyError, OSError):
+        return None
+    return os.path.join(data_path, name)
+
+
+def _read_endpoint_cache():
+    cache_path = _get_data_path(ENDPOINT_CACHE_FILE)
+    if cache_path is None or not os.path.exists(cache_path):
+        return None, 0
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data["url"], float(data["checked"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug("Ignoring Sugar-AI endpoint cache: %s", e)
+        return None, 0
+
+
+def _write_endpoint_cache(url, checked):
+    cache_path = _get_data_path(ENDPOINT_CACHE_FILE)
+    if cache_path is None:
+        return
     try:
-        response = requests.head(sugar_ai_url, timeout=2)
-        if response.ok:
-            return sugar_ai_url
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "checked": checked}, f)
+    except OSError as e:
+        logger.debug("Could not write Sugar-AI endpoint cache: %s", e)
+
+
+def probe_url(url, timeout=2):
+    try:
+        return requests.head(url, timeout=timeout).ok
     except requests.RequestException:
+        return False
+
+
+class Endpoint(object):
+    """
+    Health of one Sugar-AI server.
+
+    The circuit breaker opens after FAILURE_THRESHOLD consecutive
+    failures and lets a single trial request through once OPEN_SECONDS
+    have passed. The score is an exponentially weighted success rate.
+    Recent latencies of each operation give an adaptive read timeout,
+    so a hanging server is given up on long before the fixed 60 seconds.
+
+    Only EndpointPool touches it, holding the pool lock.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    FAILURE_THRESHOLD = 3
+    OPEN_SECONDS = 30
+    SCORE_WEIGHT = 0.3
+    LATENCY_SAMPLES = 32
+    MIN_LATENCY_SAMPLES = 5
+    TIMEOUT_FACTOR = 3
+    MIN_TIMEOUT = 10
+    MAX_TIMEOUT = 60
+
+    def __init__(self, url, score=1.0):
+        self.url = url
+        self.score = score
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._trial = False
+        # Latency samples by operation: a streamed chat turn answers in
+        # well under a second, a full extraction may take twenty
+        self._latencies = {}
+
+    def is_available(self, now):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.OPEN_SECONDS
+        return not self._trial
+
+    def acquire(self):
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self._trial = True
+
+    def release(self):
+        self._trial = False
+
+    def record_success(self, latency=None, operation=None):
+        self.score += self.SCORE_WEIGHT * (1 - self.score)
+        self.failures = 0
+        self.state = self.CLOSED
+        self._trial = False
+        if latency is not None and operation is not None:
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+                self._latencies[operation] = latencies
+            latencies.append(latency)
+
+    def record_failure(self, now):
+        self.score -= self.SCORE_WEIGHT * self.score
+        self.failures += 1
+        self._trial = False
+        if self.state == self.HALF_OPEN or \
+                self.failures >= self.FAILURE_THRESHOLD:
+            self.state = self.OPEN
+            self.opened_at = now
+
+    def get_latency_percentile(self, operation, fraction):
+        latencies = self._latencies.get(operation)
+        if not latencies:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(fraction * len(latencies)))]
+
+    def get_read_timeout(self, operation):
+        if len(self._latencies.get(operation, ())) < \
+                self.MIN_LATENCY_SAMPLES:
+            return self.MAX_TIMEOUT
+        timeout = self.get_latency_percentile(operation, 0.95) * \
+            self.TIMEOUT_FACTOR
+        return max(self.MIN_TIMEOUT, min(self.MAX_TIMEOUT, timeout))
+
+
+class EndpointPool(object):
+    """
+    Routes requests to the first healthy server in the list, or to the
+    one with the best score when none is healthy.
+
+    Servers that are not the current choice and are not known to be
+    healthy are probed in the background at most every PROBE_INTERVAL
+    seconds, so traffic moves back as soon as they recover.
+    """
+
+    PROBE_INTERVAL = 30
+    # servers scoring at least this with a closed breaker are healthy
+    HEALTHY_SCORE = 0.8
+    # score given to the servers that are not preferred at startup
+    FALLBACK_SCORE = 0.5
+
+    def __init__(self, urls):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._last_probe = 0
+        self._probing = False
+        self._preferred = self.endpoints[0]
+
+    def set_preferred(self, url, checked):
+        with self._lock:
+            for endpoint in self.endpoints:
+                if endpoint.url != url:
+                    endpoint.score = self.FALLBACK_SCORE
+            self._checked = checked
+            self._update_preferred()
+
+    def get_preferred(self):
+        return self._preferred
+
+    def _is_healthy(self, endpoint):
+        return endpoint.state == endpoint.CLOSED and \
+            endpoint.score >= self.HEALTHY_SCORE
+
+    def _pick(self, endpoints):
+        for endpoint in endpoints:
+            if self._is_healthy(endpoint):
+                return endpoint
+        return max(endpoints, key=lambda e: e.score)
+
+    def _update_preferred(self):
+        preferred = self._pick(self.endpoints)
+        changed = preferred is not self._preferred
+        self._preferred = preferred
+        return changed
+
+    def choose(self):
+        """
+        Endpoint for the next request. Report its outcome with
+        record_success(), record_failure() or release().
+        """
+        now = time.time()
+        with self._lock:
+            available = [e for e in self.endpoints if e.is_available(now)]
+            if available:
+                endpoint = self._pick(available)
+            else:
+                # every breaker is open, try the one open the longest
+                endpoint = min(self.endpoints, key=lambda e: e.opened_at)
+            endpoint.acquire()
+        self._maybe_probe(endpoint)
+        return endpoint
+
+    def has_alternative(self, endpoint):
+        now = time.time()
+        with self._lock:
+            return any(e is not endpoint and e.is_available(now)
+                       for e in self.endpoints)
+
+    def release(self, endpoint):
+        with self._lock:
+            endpoint.release()
+
+    def record_success(self, endpoint, latency=None, operation=None):
+        with self._lock:
+            endpoint.record_success(latency, operation)
+            changed = self._update_preferred()
+        if changed:
+            self._save()
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            endpoint.record_failure(time.time())
+            changed = self._update_preferred()
+        if changed:
+            logger.debug("Sugar-AI failing over to %s", self._preferred.url)
+            self._save()
+
+    def _save(self):
+        _write_endpoint_cache(self._preferred.url, self._checked)
+
+    def is_checked(self):
+        return self._checked > 0
+
+    def is_stale(self):
+        return time.time() - self._checked > ENDPOINT_CACHE_TTL
+
+    def probe(self, endpoints=None):
+        """
+        HEAD each of endpoints (default all) and feed the result into
+        their health. Blocking.
+        """
+        if endpoints is None:
+            endpoints = self.endpoints
+            full = True
+        else:
+            full = False
+        for endpoint in endpoints:
+            if probe_url(endpoint.url):
+                self.record_success(endpoint)
+            else:
+                self.record_failure(endpoint)
+        if full:
+            self._checked = time.time()
+            self._save()
+        logger.debug("Sugar-AI endpoint probe, preferring %s",
+                     self._preferred.url)
+
+    def probe_async(self, endpoints=None):
+        with self._lock:
+            if self._probing:
+                return
+            self._probing = True
+            self._last_probe = time.time()
+        thread = threading.Thread(target=self._probe_thread,
+                                  args=(endpoints,))
+        thread.daemon = True
+        thread.start()
+
+    def _probe_thread(self, endpoints):
+        try:
+            self.probe(endpoints)
+        finally:
+            with self._lock:
+                self._probing = False
+
+    def _maybe_probe(self, chosen):
+        if len(self.endpoints) < 2:
+            return
+        if self.is_stale():
+            self.probe_async()
+            return
+        if time.time() - self._last_probe < self.PROBE_INTERVAL:
+            return
+        with self._lock:
+            unhealthy = [e for e in self.endpoints
+                         if e is not chosen and not self._is_healthy(e)]
+        if unhealthy:
+            self.probe_async(unhealthy)
+
+
+_endpoint_lock = threading.Lock()
+_endpoint_pool = None
+
+
+def get_endpoint_pool():
+    """
+    The EndpointPool of the Sugar-AI cloud and local servers, or of
+    SUGAR_AI_URL alone when that is set.
+    """
+    global _endpoint_pool
+    with _endpoint_lock:
+        if _endpoint_pool is None:
+            if url_override:
+                _endpoint_pool = EndpointPool([url_override.rstrip("/")])
+                _endpoint_pool.set_preferred(_endpoint_pool.endpoints[0].url,
+                                             time.time())
+            else:
+                _endpoint_pool = EndpointPool([sugar_ai_url, local_url])
+                url, checked = _read_endpoint_cache()
+                if url is not None:
+                    _endpoint_pool.set_preferred(url, checked)
+        return _endpoint_pool
+
+
+def refresh_api_url(force=False):
+    """
+    Re-probe the Sugar-AI servers on a background thread if the cached
+    result is stale (or unconditionally with force=True). Nothing is
+    probed when another backend is selected.
+    """
+    if url_override or not isinstance(get_backend(), SugarAIBackend):
+        return
+    pool = get_endpoint_pool()
+    if force or pool.is_stale():
+        pool.probe_async()
+
+
+def get_api_url():
+    """
+    Base URL of the currently preferred Sugar-AI server.
+
+    Only the very first call without any cached result probes the network
+    synchronously; callers are expected to run on a worker thread.
+    """
+    pool = get_endpoint_pool()
+    if not pool.is_checked():
+        pool.probe()
+    return pool.get_preferred().url
+
+
+class SugarAIClient(object):
+    """
+    Shared HTTP client for the Sugar-AI server.
+
+    A single keep-alive session with a small connection pool is reused
+    for every request, so chat turns, framework extraction and advice do
+    not pay a new TCP and TLS handshake each time. Connection failures
+    and 429/5xx answers are retried with bounded exponential backoff;
+    every logical call carries one Idempotency-Key across its retries.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+    # Answers of a server that could not read a compressed body: 415 if
+    # it says so, JSON APIs usually fail to parse it with 400 or 422
+    COMPRESSION_REJECTED_STATUSES = (400, 415, 422)
+
+    def __init__(self, key=None, pool_size=4, max_retries=2,
+                 backoff=0.5, max_backoff=4.0, connect_timeout=5,
+                 read_timeout=60, base_url=None, headers=None,
+                 compress_min_bytes=4096):
+        # None routes through the Sugar-AI endpoint pool
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Bodies of at least this size are sent gzip compressed, unless
+        # the server rejected a compressed body before
+        self.compress_min_bytes = compress_min_bytes
+        self._uncompressed_urls = set()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                              max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers["Content-Type"] = "application/json"
+        if key:
+            self._session.headers["X-API-KEY"] = key
+        if headers:
+            self._session.headers.update(headers)
+
+    def _get_base_url(self):
+        return self.base_url if self.base_url is not None else get_api_url()
+
+    def _backoff_delay(self, attempt, response=None):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(self.max_backoff, float(retry_after))
+        # jitter, so that a classroom of laptops does not retry in step
+        return delay * random.uniform(0.5, 1.0)
+
+    def post(self, path, payload, timeout=None, stream=False,
+             headers=None, metrics_key=None):
+        """
+        POST a JSON payload to path on the Sugar-AI server.
+
+        timeout is either a number of seconds for the read or a
+        (connect, read) tuple; it defaults to the client settings, with
+        the read timeout adapted to the observed latency of the server.
+        Without a base_url, every attempt goes to the healthiest server
+        of the endpoint pool, so retries fail over.
+        Returns the successful requests.Response, raises
+        requests.RequestException otherwise, or RequestCancelled once the
+        calling LLMRequest is cancelled. Statistics are recorded in
+        get_metrics() under metrics_key, which defaults to path; those
+        of a streamed response are recorded by whoever consumes it.
+        """
+        request_headers = {"Idempotency-Key": uuid.uuid4().hex}
+        if headers:
+            request_headers.update(headers)
+
+        body = json.dumps(payload).encode("utf-8")
+        compressed_body = None
+        metrics = get_metrics()
+        if metrics_key is None:
+            metrics_key = path
+        # The read timeout of a stream bounds the wait for the first
+        # bytes, that of a full response the whole generation; their
+        # latencies are tracked apart
+        operation = metrics_key + (":stream" if stream else "")
+
+        pool = None
+        if self.base_url is None:
+            pool = get_endpoint_pool()
+            if not pool.is_checked():
+                pool.probe()
+
+        # Server that rejected the compressed body of this call, if any
+        rejected_url = None
+        attempt = 0
+        while True:
+            check_cancelled()
+            endpoint = None
+            if pool is not None:
+                endpoint = pool.choose()
+                base_url = endpoint.url
+            else:
+                base_url = self.base_url
+            url = f"{base_url}{path}"
+            request_timeout = self._get_timeout(timeout, endpoint, operation)
+
+            send_body = body
+            send_headers = request_headers
+            if len(body) >= self.compress_min_bytes and \
+                    rejected_url is None and \
+                    base_url not in self._uncompressed_urls:
+                if compressed_body is None:
+                    compressed_body = gzip.compress(body, 6)
+                send_body = compressed_body
+                send_headers = dict(request_headers)
+                send_headers["Content-Encoding"] = "gzip"
+
+            response = None
+            started = time.time()
+            try:
+                response = self._session.post(
+                    url, data=send_body, headers=send_headers,
+                    timeout=request_timeout, stream=stream)
+            except requests.RequestException as e:
+                metrics.record_error(metrics_key, e)
+                if endpoint is not None:
+                    pool.record_failure(endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                # a read timeout is only retried on another server, this
+                # one may still be generating
+                can_fail_over = endpoint is not None and \
+                    pool.has_alternative(endpoint)
+                if not isinstance(e, requests.ConnectionError) and \
+                        not can_fail_over:
+                    raise
+            except Exception:
+                if endpoint is not None:
+                    pool.release(endpoint)
+                raise
+            else:
+                latency = time.time() - started
+                if not stream or not response.ok:
+                    metrics.record_request(
+                        metrics_key, latency, len(send_body),
+                        len(response.content))
+                if endpoint is not None:
+                    if response.status_code == 429:
+                        # rate limited, but the server itself is fine
+                        pool.release(endpoint)
+                    elif response.status_code >= 500:
+                        pool.record_failure(endpoint)
+                    else:
+                        pool.record_success(
+                            endpoint, response.elapsed.total_seconds()
+                            if stream else latency, operation)
+                if response.status_code in \
+                        self.COMPRESSION_REJECTED_STATUSES and \
+                        send_body is not body:
+                    # the server may not decode compressed bodies, or the
+                    # request is wrong anyway: resend it uncompressed
+                    rejected_url = base_url
+                    response.close()
+                    continue
+                if response.ok and base_url == rejected_url and \
+                        base_url not in self._uncompressed_urls:
+                    # the uncompressed body went through, so compression
+                    # was the problem: keep it off for this server
+                    logger.debug("%s does not accept compressed requests",
+                                 base_url)
+                    self._uncompressed_urls.add(base_url)
+                if response.status_code not in self.RETRY_STATUSES or \
+                        attempt >= self.max_retries:
+                    try:
+                        response.raise_for_status()
+                        check_cancelled()
+                    except requests.HTTPError as e:
+                        metrics.record_error(metrics_key, e)
+                        response.close()
+                        raise
+                    except RequestCancelled:
+                        response.close()
+                        raise
+                    return response
+                metrics.record_error(metrics_key,
+                                     f"HTTP {response.status_code}")
+                response.close()
+
+            metrics.record_retry(metrics_key)
+            delay = self._backoff_delay(attempt, response)
+            logger.debug("Retrying Sugar-AI request to %s in %.1fs",
+                         path, delay)
+            _sleep(delay)
+            attempt += 1
+
+    def _get_timeout(self, timeout, endpoint, operation):
+        if timeout is None:
+            read_timeout = self.read_timeout
+            if endpoint is not None:
+                read_timeout = min(read_timeout,
+                                   endpoint.get_read_timeout(operation))
+            return (self.connect_timeout, read_timeout)
+        if isinstance(timeout, tuple):
+            return timeout
+        return (min(self.connect_timeout, timeout), timeout)
+
+
+class RequestMetrics(object):
+    """
+    Latency, payload size, retry and error statistics of LLM requests,
+    grouped by endpoint key ("<backend>:<operation>").
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds; the
+    # last bucket counts everything slower
+    LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._endpoints = {}
+
+    def _get_stats(self, key):
+        stats = self._endpoints.get(key)
+        if stats is None:
+            stats = {
+                "requests": 0,
+                "retries": 0,
+                "cache_hits": 0,
+                "errors": {},
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "latency_sum": 0.0,
+                "latency_max": 0.0,
+                "latency_histogram": [0] * (len(self.LATENCY_BUCKETS) + 1),
+                "first_byte_sum": 0.0,
+                "streams": 0
+            }
+            self._endpoints[key] = stats
+        return stats
+
+    def record_request(self, key, latency, bytes_sent, bytes_received,
+                       first_byte=None):
+        bucket = len(self.LATENCY_BUCKETS)
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        with self._lock:
+            stats = self._get_stats(key)
+            stats["requests"] += 1
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+            stats["latency_sum"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            stats["latency_histogram"][bucket] += 1
+            if first_byte is not None:
+                stats["streams"] += 1
+                stats["first_byte_sum"] += first_byte
+
+    def record_retry(self, key):
+        with self._lock:
+            self._get_stats(key)["retries"] += 1
+
+    def record_cache_hit(self, key):
+        with self._lock:
+            self._get_stats(key)["cache_hits"] += 1
+
+    def record_error(self, key, error):
+        if isinstance(error, requests.HTTPError) and \
+                error.response is not None:
+            name = f"HTTP {error.response.status_code}"
+        elif isinstance(error, str):
+            name = error
+        else:
+            name = type(error).__name__
+        with self._lock:
+            errors = self._get_stats(key)["errors"]
+            errors[name] = errors.get(name, 0) + 1
+
+    def snapshot(self):
+        """
+        A JSON serializable copy of the statistics.
+        """
+        labels = [f"<={bound}s" for bound in self.LATENCY_BUCKETS]
+        labels.append(f">{self.LATENCY_BUCKETS[-1]}s")
+        with self._lock:
+            endpoints = {}
+            for key, stats in self._endpoints.items():
+                stats = dict(stats)
+                stats["errors"] = dict(stats["errors"])
+                stats["latency_histogram"] = dict(
+                    zip(labels, stats["latency_histogram"]))
+                endpoints[key] = stats
+        return {"started": self._started, "updated": time.time(),
+                "endpoints": endpoints}
+
+    def is_empty(self):
+        with self._lock:
+            return not self._endpoints
+
+
+_metrics = RequestMetrics()
+
+# Sessions kept in the metrics file written by dump_metrics()
+METRICS_MAX_SESSIONS = 20
+
+
+def get_metrics():
+    return _metrics
+
+
+def dump_metrics(path=None):
+    """
+    Write the statistics of this session to the activity log and, when
+    path is given, into that JSON file, which keeps the most recent
+    METRICS_MAX_SESSIONS sessions keyed by their start time.
+    """
+    if _metrics.is_empty():
+        return
+    snapshot = _metrics.snapshot()
+    logger.debug("Sugar-AI request metrics: %s", json.dumps(snapshot))
+    if path is None:
+        return
+
+    sessions = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            sessions = json.load(f)
+    except (OSError, ValueError):
         pass
-    
-    return local_url
+    if not isinstance(sessions, dict):
+        sessions = {}
+    sessions[str(snapshot["started"])] = snapshot
+    for key in sorted(sessions, key=float)[:-METRICS_MAX_SESSIONS]:
+        del sessions[key]
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(sessions, f, indent=1)
+    except OSError as e:
+        logger.debug("Could not write Sugar-AI metrics: %s", e)
+
 
-def load_story_prompt():
-    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "story_qa_prompt.txt")
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read()
+def dump_metrics_to_profile():
+    dump_metrics(_get_data_path("sugarai-metrics.json"))
 
-SUGAR_AI_API_URL = load_url()
-story_prompt = load_story_prompt()
 
-def get_llm_response(messages, system_prompt=None):
+_client_lock = threading.Lock()
+_client = None
+
+
+def get_client():
     """
-    Get response from LLM using the story prompt as system prompt if not provided.
+    The SugarAIClient shared by all Sugar-AI calls.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SugarAIClient(api_key)
+        return _client
+
+
+class ResponseCache(object):
+    """
+    Memoize Sugar-AI answers keyed on a hash of the full request.
+
+    Recent answers live in an in-memory LRU; all answers are also kept in
+    a size-bounded directory under the activity root, so they survive a
+    restart. Only deterministic callers should use it, chat turns bypass
+    it with use_cache=False.
     """
+
+    def __init__(self, path=None, max_entries=64,
+                 max_disk_bytes=2 * 1024 * 1024):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            try:
+                os.makedirs(path, exist_ok=True)
+            except OSError as e:
+                logger.debug("Disabling on-disk Sugar-AI cache: %s", e)
+                self._path = None
+
+    @staticmethod
+    def make_key(path, payload):
+        data = json.dumps([path, payload], sort_keys=True,
+                          ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _file_path(self, key):
+        return os.path.join(self._path, key + ".json")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self._path is None:
+            return None
+
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            # the mtime is the on-disk LRU clock
+            os.utime(file_path)
+        except (OSError, ValueError):
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self._path is None:
+            return
+
+        file_path = self._file_path(key)
+        tmp_path = file_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.debug("Could not store Sugar-AI answer: %s", e)
+            return
+        self._prune_disk()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        try:
+            files = []
+            for name in os.listdir(self._path):
+                file_path = os.path.join(self._path, name)
+                stat = os.stat(file_path)
+                files.append((stat.st_mtime, stat.st_size, file_path))
+        except OSError:
+            return
+
+        total = sum(size for mtime, size, file_path in files)
+        for mtime, size, file_path in sorted(files):
+            if total <= self._max_disk_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total -= size
+
+
+_cache = None
+
+
+def get_response_cache():
+    """
+    The ResponseCache shared by all Sugar-AI calls.
+    """
+    global _cache
+    with _client_lock:
+        if _cache is None:
+            _cache = ResponseCache(_get_data_path("llm-cache"))
+        return _cache
+
+
+def _cached_post(client, path, payload, extract, use_cache=True,
+                 timeout=None, metrics_key=None, validate=None):
+    """
+    POST payload and return extract(response_json), answering from the
+    response cache when possible.
+
+    If validate is given the answer is only cached when validate(answer)
+    is true, so an answer the caller cannot use is asked for again.
+    """
+    cache = get_response_cache() if use_cache else None
+    if cache is not None:
+        key = cache.make_key(str(metrics_key) + path, payload)
+        value = cache.get(key)
+        if value is not None:
+            get_metrics().record_cache_hit(metrics_key)
+            return value
+
+    response = client.post(path, payload, timeout=timeout,
+                           metrics_key=metrics_key)
     try:
-        sys_prompt = system_prompt if system_prompt else story_prompt
-        full_messages = [{"role": "system", "content": sys_prompt}] + messages
-        headers = {
-            "X-API-KEY": api_key,
-            "Content-Type": "application/json"
-        }
+        value = extract(response.json())
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        get_metrics().record_error(metrics_key, e)
+        raise
+    if cache is not None and (validate is None or validate(value)):
+        cache.put(key, value)
+    return value
+
+
+def _chunk_text(chunk):
+    """
+    Pull the generated text out of one streamed chunk.
+
+    Both OpenAI style deltas and bare {"token": ...} objects are accepted.
+    """
+    choices = chunk.get("choices")
+    if choices:
+        choice = choices[0]
+        delta = choice.get("delta") or choice.get("message") or {}
+        return delta.get("content") or choice.get("text") or ""
+    return chunk.get("token") or chunk.get("content") or ""
+
+
+def _iter_stream_text(response):
+    """
+    Yield text fragments from a streamed chat response.
+
+    Server-sent events and newline delimited JSON are decoded chunk by
+    chunk, plain text is passed through as it arrives, and servers that
+    ignore the stream flag and answer with one JSON body still work.
+    """
+    content_type = response.headers.get("Content-Type", "")
+    if "application/json" in content_type:
+        data = response.json()
+        yield data["choices"][0]["message"]["content"]
+        return
+
+    if "text/plain" in content_type:
+        for text in response.iter_content(chunk_size=None,
+                                          decode_unicode=True):
+            if text:
+                yield text
+        return
 
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or line.startswith(":"):
+            continue
+        if line.startswith("data:"):
+            line = line[len("data:"):].strip()
+        if line == "[DONE]":
+            break
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            yield line
+            continue
+        text = _chunk_text(chunk)
+        if text:
+            yield text
+
+
+def _stream_post(client, path, payload, on_chunk, timeout=None,
+                 metrics_key=None):
+    """
+    POST payload, calling on_chunk with each streamed text fragment.
+    Returns the complete text.
+    """
+    headers = {"Accept": "text/event-stream, application/json"}
+    started = time.time()
+    response = client.post(path, payload, timeout=timeout, stream=True,
+                           headers=headers, metrics_key=metrics_key)
+    with response:
+        fragments = []
+        try:
+            for text in _iter_stream_text(response):
+                # leaving the with block closes the connection, which
+                # tells the server to stop generating
+                check_cancelled()
+                fragments.append(text)
+                on_chunk(text)
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            get_metrics().record_error(metrics_key, e)
+            raise
+        get_metrics().record_request(
+            metrics_key, time.time() - started, len(response.request.body),
+            response.raw.tell(), response.elapsed.total_seconds())
+    return "".join(fragments)
+
+
+class LLMBackend(object):
+    """
+    A language model server the story builder can talk to.
+
+    Adapters implement chat() for conversations and extract() for
+    structured tasks. They raise on failure; the module level
+    get_llm_response* helpers turn errors into ERROR_PREFIX answers, so
+    callers never depend on a specific backend.
+    """
+
+    name = None
+
+    def chat(self, messages, on_chunk=None, timeout=None, use_cache=True):
+        """
+        Answer a conversation whose first message is the system prompt.
+
+        With on_chunk the answer is streamed and on_chunk is called with
+        every fragment; streamed answers are never cached.
+        """
+        raise NotImplementedError
+
+    def extract(self, question, custom_prompt, timeout=None,
+                use_cache=True, validate=None):
+        """
+        Answer question following custom_prompt, for structured tasks.
+        Answers are cached only if validate, when given, accepts them.
+        """
+        raise NotImplementedError
+
+
+class SugarAIBackend(LLMBackend):
+    """
+    Adapter for the Sugar-AI /ask-llm-prompted endpoint.
+    """
+
+    name = "sugar-ai"
+    PATH = "/ask-llm-prompted"
+
+    def __init__(self, client=None):
+        self._client = client
+
+    def _get_client(self):
+        return self._client if self._client is not None else get_client()
+
+    def chat(self, messages, on_chunk=None, timeout=None, use_cache=True):
         payload = {
             "chat": True,
-            "messages": full_messages,
+            "messages": messages,
             "max_length": 512,
             "temperature": 0.6,
             "top_p": 0.9,
             "top_k": 50
         }
+        if on_chunk is not None:
+            payload["stream"] = True
+            return _stream_post(self._get_client(), self.PATH, payload,
+                                on_chunk, timeout, self.name + ":chat")
 
-        response = requests.post(
-            f"{SUGAR_AI_API_URL}/ask-llm-prompted",
-            headers=headers,
-            json=payload,
-            timeout=60
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data["choices"][0]["message"]["content"]
-    except Exception as e:
-        return f"Sorry, I encountered an error: {str(e)}"
-    
-def get_llm_response_framework(messages, custom_prompt):
-    """
-    Get response from LLM using the /ask-llm-prompted endpoint for structured responses.
-    This endpoint is better for avoiding hallucination in structured tasks.
+        return _cached_post(
+            self._get_client(), self.PATH, payload,
+            lambda data: data["choices"][0]["message"]["content"],
+            use_cache, timeout, self.name + ":chat")
 
-    Returns:
-        str: The answer content from the LLM response
-    """
-    try:      
-        headers = {
-            "X-API-KEY": api_key,
-            "Content-Type": "application/json"
-        }
-        
-        # Convert messages list to a single string for the question parameter
-        question_text = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
-        
+    def extract(self, question, custom_prompt, timeout=None,
+                use_cache=True, validate=None):
         payload = {
-            "question": question_text,
+            "question": question,
             "custom_prompt": custom_prompt,
             "max_length": 1024,
             "truncation": True,
@@ -104,12 +1090,211 @@ def get_llm_response_framework(messages, custom_prompt):
             "top_p": 0.9,
             "top_k": 50
         }
-        
-        response = requests.post(f"{SUGAR_AI_API_URL}/ask-llm-prompted", headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        
-        return data["answer"]
-        
+        return _cached_post(self._get_client(), self.PATH, payload,
+                            lambda data: data["answer"], use_cache, timeout,
+                            self.name + ":extract", validate)
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Adapter for self-hosted inference servers speaking the OpenAI chat
+    completions API, such as llama.cpp or vLLM.
+    """
+
+    name = "openai"
+    PATH = "/v1/chat/completions"
+
+    def __init__(self, base_url, model="default", key=None):
+        self.model = model
+        headers = {}
+        if key:
+            headers["Authorization"] = "Bearer " + key
+        self._client = SugarAIClient(base_url=base_url.rstrip("/"),
+                                     headers=headers)
+
+    def _payload(self, messages, max_tokens, temperature):
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": 0.9
+        }
+
+    def chat(self, messages, on_chunk=None, timeout=None, use_cache=True):
+        payload = self._payload(messages, 512, 0.6)
+        if on_chunk is not None:
+            payload["stream"] = True
+            return _stream_post(self._client, self.PATH, payload, on_chunk,
+                                timeout, self.name + ":chat")
+
+        return _cached_post(
+            self._client, self.PATH, payload,
+            lambda data: data["choices"][0]["message"]["content"],
+            use_cache, timeout, self.name + ":chat")
+
+    def extract(self, question, custom_prompt, timeout=None,
+                use_cache=True, validate=None):
+        messages = [{"role": "system", "content": custom_prompt},
+                    {"role": "user", "content": question}]
+        return _cached_post(
+            self._client, self.PATH, self._payload(messages, 1024, 0.7),
+            lambda data: data["choices"][0]["message"]["content"],
+            use_cache, timeout, self.name + ":extract", validate)
+
+
+_backend = None
+
+
+def _create_backend():
+    if os.getenv("SUGAR_AI_BACKEND") == OpenAICompatibleBackend.name:
+        return OpenAICompatibleBackend(
+            os.getenv("SUGAR_AI_BACKEND_URL", local_url),
+            os.getenv("SUGAR_AI_BACKEND_MODEL", "default"), api_key)
+    return SugarAIBackend()
+
+
+def get_backend():
+    """
+    The LLMBackend used by the story builder.
+
+    Sugar-AI is used unless SUGAR_AI_BACKEND=openai selects an OpenAI
+    compatible server at SUGAR_AI_BACKEND_URL.
+    """
+    global _backend
+    with _client_lock:
+        if _backend is None:
+            _backend = _create_backend()
+        return _backend
+
+
+def _with_system_prompt(messages, system_prompt):
+    sys_prompt = system_prompt if system_prompt else \
+        get_prompt("story_qa_prompt")
+    return [{"role": "system", "content": sys_prompt}] + messages
+
+
+def get_llm_response(messages, system_prompt=None, timeout=None,
+                     use_cache=True):
+    """
+    Get response from LLM using the story prompt as system prompt if not provided.
+
+    Identical requests are answered from the response cache unless
+    use_cache is False.
+    """
+    try:
+        return get_backend().chat(
+            _with_system_prompt(messages, system_prompt), timeout=timeout,
+            use_cache=use_cache)
+    except Exception as e:
+        return f"{ERROR_PREFIX}: {str(e)}"
+
+
+def get_llm_response_stream(messages, system_prompt=None, on_chunk=None,
+                            timeout=None):
+    """
+    Streaming variant of get_llm_response.
+
+    on_chunk is called with every text fragment as soon as it is
+    received; the complete response is returned at the end.
+    """
+    if on_chunk is None:
+        return get_llm_response(messages, system_prompt, timeout, False)
+    try:
+        return get_backend().chat(
+            _with_system_prompt(messages, system_prompt), on_chunk,
+            timeout)
     except Exception as e:
-        return f"Sorry, I encountered an error: {str(e)}"
+        return f"{ERROR_PREFIX}: {str(e)}"
+
+
+def get_llm_response_framework(messages, custom_prompt, timeout=None,
+                               use_cache=True, validate=None):
+    """
+    Get response from LLM using the /ask-llm-prompted endpoint for structured responses.
+    This endpoint is better for avoiding hallucination in structured tasks.
+
+    Identical requests are answered from the response cache unless
+    use_cache is False. validate(answer), if given, tells whether the
+    caller could parse the answer; others are not cached.
+
+    Returns:
+        str: The answer content from the LLM response
+    """
+    try:
+        # Convert messages list to a single string for the question parameter
+        question_text = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+        return get_backend().extract(question_text, custom_prompt, timeout,
+                                     use_cache, validate)
+
+    except Exception as e:
+        return f"{ERROR_PREFIX}: {str(e)}"
+
+
+class LLMRequest(object):
+    """
+    Run a blocking Sugar-AI call on a worker thread.
+
+    The result is handed back to the GTK main loop through
+    GLib.idle_add, so callbacks may touch widgets directly.
+
+    cancel() stops retries, backoff waits and streamed reads, and
+    guarantees that no callback runs afterwards. A request already
+    waiting for the server's answer is abandoned rather than aborted.
+    """
+
+    def __init__(self, func, args=(), callback=None, chunk_callback=None):
+        self._func = func
+        self._args = args
+        self._callback = callback
+        self._chunk_callback = chunk_callback
+        if chunk_callback is not None:
+            self._args = tuple(args) + (self._emit_chunk,)
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _run(self):
+        _request_local.cancel_event = self._cancel_event
+        try:
+            result = self._func(*self._args)
+        except RequestCancelled:
+            return
+        except Exception as e:
+            logger.error('Sugar-AI request failed: %s', e)
+            result = f"{ERROR_PREFIX}: {str(e)}"
+        GLib.idle_add(self._deliver, result)
+
+    def _emit_chunk(self, text):
+        check_cancelled()
+        GLib.idle_add(self._deliver_chunk, text)
+
+    def _deliver_chunk(self, text):
+        if not self.is_cancelled():
+            self._chunk_callback(text)
+        return False
+
+    def _deliver(self, result):
+        if self._callback is not None and not self.is_cancelled():
+            self._callback(result)
+        return False
+
+
+def get_llm_response_async(messages, callback, system_prompt=None):
+    """
+    Non-blocking variant of get_llm_response.
+
+    The callback is called on the main loop with the response text.
+    """
+    return LLMRequest(get_llm_response, (list(messages), system_prompt),
+                      callback).start()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Local stand-in for the Sugar-AI server.
+
+Implements /ask-llm-prompted with canned answers, a configurable
+latency and configurable answer sizes, so the chat, framework and
+advice paths of Write can be load-tested and benchmarked offline:
+
+    python3 sugarai_stub_server.py --latency 0.5 --tokens 200
+    SUGAR_AI_URL=http://localhost:8000 sugar-activity3 ...
+"""
+
+import json
+import zlib
+import time
+import random
+import argparse
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('sugarai-stub-server')
+
+WORDS = ('once', 'upon', 'a', 'time', 'there', 'was', 'brave', 'little',
+         'dragon', 'who', 'lived', 'in', 'the', 'forest', 'and', 'loved',
+         'to', 'sing', 'with', 'friends', 'every', 'morning')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'SugarAIStub/1.0'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'detail': 'Not Found'})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def _decode_body(self, body):
+        encoding = self.headers.get('Content-Encoding', 'identity').lower()
+        if encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                # raw deflate stream without the zlib header
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        if encoding == 'identity':
+            return body
+        raise LookupError(encoding)
+
+    def do_POST(self):
+        if self.path != '/ask-llm-prompted':
+            self._send_json(404, {'detail': 'Not Found'})
+            return
+
+        # always consume the body, the connection is kept alive
+        body = self._read_body()
+        if self.server.config.no_compression and \
+                'Content-Encoding' in self.headers:
+            self._send_json(415, {'detail': 'Unsupported Content-Encoding'})
+            return
+        try:
+            payload = json.loads(self._decode_body(body).decode('utf-8'))
+        except LookupError:
+            self._send_json(415, {'detail': 'Unsupported Content-Encoding'})
+            return
+        except (ValueError, zlib.error):
+            self._send_json(400, {'detail': 'Invalid request body'})
+            return
+
+        config = self.server.config
+        if config.api_key and \
+                self.headers.get('X-API-KEY') != config.api_key:
+            self._send_json(401, {'detail': 'Invalid API key'})
+            return
+        if random.random() < config.error_rate:
+            self._send_json(503, {'detail': 'Simulated overload'})
+            return
+
+        time.sleep(config.latency)
+
+        if not payload.get('chat'):
+            answer = self._structured_answer(payload.get('custom_prompt', ''))
+            self._send_json(200, {'answer': answer})
+        elif payload.get('stream'):
+            self._stream_answer()
+        else:
+            answer = ' '.join(self._tokens())
+            self._send_json(200, {'choices': [
+                {'message': {'role': 'assistant', 'content': answer}}]})
+
+    def _tokens(self):
+        count = self.server.config.tokens
+        return [WORDS[i % len(WORDS)] for i in range(count)]
+
+    def _structured_answer(self, custom_prompt):
+        # answer JSON prompts by filling in the skeleton they contain
+        start = custom_prompt.find('{')
+        end = custom_prompt.rfind('}') + 1
+        try:
+            skeleton = json.loads(custom_prompt[start:end])
+        except ValueError:
+            return ' '.join(self._tokens())
+        return json.dumps(self._fill(skeleton))
+
+    def _fill(self, skeleton):
+        if isinstance(skeleton, dict):
+            return dict((key, self._fill(value))
+                        for key, value in skeleton.items())
+        return ' '.join(self._tokens()[:3])
+
+    def _stream_answer(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for i, token in enumerate(self._tokens()):
+                if i:
+                    token = ' ' + token
+                event = {'choices': [{'delta': {'content': token}}]}
+                self._send_chunk(
+                    b'data: ' + json.dumps(event).encode('utf-8') + b'\n\n')
+                time.sleep(self.server.config.token_delay)
+            self._send_chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the request
+            logger.debug('Client went away while streaming')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Sugar-AI server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before answering')
+    parser.add_argument('--tokens', type=int, default=60,
+                        help='number of words in each answer')
+    parser.add_argument('--token-delay', type=float, default=0.02,
+                        help='seconds between streamed words')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 503')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='answer 415 to compressed request bodies')
+    parser.add_argument('--api-key', default=None,
+                        help='reject requests without this X-API-KEY')
+    parser.add_argument('--verbose', action='store_true')
+    config = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if config.verbose else logging.INFO)
+    server = ThreadingHTTPServer((config.host, config.port), StubHandler)
+    server.config = config
+    logger.info('Serving stand-in Sugar-AI on http://%s:%d',
+                config.host, config.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
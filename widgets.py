@@ -15,6 +15,7 @@
 import os
 import dbus
 import time
+import collections
 from gettext import gettext as _
 import logging
 
@@ -29,6 +30,7 @@ from gi.repository import GLib
 from sugar3.graphics.radiotoolbutton import RadioToolButton
 from sugar3.graphics.toolbutton import ToolButton
 from sugar3.graphics.palettemenu import PaletteMenuItem
+from sugar3.graphics.alert import Alert, NotifyAlert
 from sugar3.datastore import datastore
 
 from sugar3.activity.activity import SCOPE_PRIVATE
@@ -146,6 +148,7 @@ class ExportButtonFactory():
 
     def __init__(self, activity, abi):
 
+        self._queue = ExportQueue(activity, abi)
         toolbar = activity.activity_button.props.page
         for i in self._EXPORT_FORMATS:
             if abi.get_version() == '3.0' and i['title'].find('PDF') > -1:
@@ -159,23 +162,50 @@ class ExportButtonFactory():
 
     def __clicked_cb(self, menu_item, activity, abi, format):
         logger.debug('exporting file: %r' % format)
+        self._queue.add(format)
 
-        exp_props = format['exp_props']
 
-        # special case HTML export to set the activity name as the HTML title
-        if format['mime_type'] == "text/html":
-            exp_props += " title:" + activity.metadata['title'] + ';'
+class ExportQueue(object):
+    """
+    Exports to the Journal, run one after the other.
+
+    Each export is split in steps run from the main loop, so the activity
+    stays responsive between them and the child can keep editing; an
+    alert shows the progress. AbiWord is not thread safe, so the
+    conversion itself still runs on the main loop, but the Journal write
+    is asynchronous.
+    """
+
+    def __init__(self, activity, abi):
+        self._activity = activity
+        self._abi = abi
+        self._jobs = collections.deque()
+        self._current = None
+        self._alert = None
+        self._failed = 0
+
+    def add(self, format):
+        # Snapshot the metadata right away, the document is exported as it
+        # is when the job is started
+        self._jobs.append(self._create_journal_object(format))
+        if self._current is None:
+            self._start_next()
+        else:
+            self._update_alert()
+
+    def _create_journal_object(self, format):
+        activity = self._activity
+        act_meta = activity.metadata
 
         # create a new journal item
         fileObject = datastore.create()
-        act_meta = activity.metadata
         fileObject.metadata['title'] = \
             act_meta['title'] + ' (' + format['jpostfix'] + ')'
         fileObject.metadata['title_set_by_user'] = \
             act_meta['title_set_by_user']
         fileObject.metadata['mime_type'] = format['mime_type']
         fileObject.metadata['fulltext'] = \
-            abi.get_content('text/plain', None)[0][:3000]
+            self._abi.get_content_snapshot('text/plain')[:3000]
 
         fileObject.metadata['icon-color'] = act_meta['icon-color']
 
@@ -185,31 +215,144 @@ class ExportButtonFactory():
 
         fileObject.metadata['keep'] = act_meta.get('keep', '0')
 
-        preview = activity.get_preview()
+        fileObject.metadata['share-scope'] = act_meta.get('share-scope',
+                                                          SCOPE_PRIVATE)
+        return fileObject, format
+
+    def _start_next(self):
+        if not self._jobs:
+            self._current = None
+            self._finish()
+            return
+        self._current = self._jobs.popleft()
+        self._update_alert()
+        GLib.idle_add(self.__preview_step_cb)
+
+    def __preview_step_cb(self):
+        fileObject, format = self._current
+        # shared with saves of the same revision, see
+        # AbiWordActivity.get_preview
+        preview = self._activity.get_preview()
         if preview is not None:
             fileObject.metadata['preview'] = dbus.ByteArray(preview)
+        GLib.idle_add(self.__save_step_cb)
+        return False
 
-        fileObject.metadata['share-scope'] = act_meta.get('share-scope',
-                                                          SCOPE_PRIVATE)
+    def __save_step_cb(self):
+        fileObject, format = self._current
+
+        exp_props = format['exp_props']
+
+        # special case HTML export to set the activity name as the HTML title
+        if format['mime_type'] == "text/html":
+            exp_props += " title:" + self._activity.metadata['title'] + ';'
 
         # write out the document contents in the requested format
-        fileObject.file_path = os.path.join(activity.get_activity_root(),
-                                            'instance', '%i' % time.time())
-        abi.save('file://' + fileObject.file_path,
-                 format['mime_type'], exp_props)
+        fileObject.file_path = os.path.join(
+            self._activity.get_activity_root(), 'instance',
+            '%i-%s' % (time.time(), format['icon']))
+        try:
+            if not self._abi.save('file://' + fileObject.file_path,
+                                  format['mime_type'], exp_props):
+                raise IOError('AbiWord could not convert the document')
+        except (IOError, OSError) as e:
+            if os.path.exists(fileObject.file_path):
+                os.unlink(fileObject.file_path)
+            self.__write_error_cb(e)
+            return False
 
         # store the journal item
-        datastore.write(fileObject, transfer_ownership=True)
+        datastore.write(fileObject, transfer_ownership=True,
+                        reply_handler=self.__write_reply_cb,
+                        error_handler=self.__write_error_cb)
+        return False
+
+    def __write_reply_cb(self):
+        self._end_job()
+
+    def __write_error_cb(self, error):
+        fileObject, format = self._current
+        logger.error('Error exporting to %s: %s', format['mime_type'], error)
+        self._failed += 1
+        self._end_job()
+
+    def _end_job(self):
+        fileObject, format = self._current
         fileObject.destroy()
-        del fileObject
+        self._current = None
+        self._start_next()
+
+    def _update_alert(self):
+        fileObject, format = self._current
+        if self._alert is None:
+            self._alert = Alert()
+            self._alert.props.title = _('Exporting')
+            self._activity.add_alert(self._alert)
+        message = _('Saving a copy as %s to the Journal...') % \
+            format['jpostfix']
+        if self._jobs:
+            message += ' ' + _('(%d more)') % len(self._jobs)
+        self._alert.props.msg = message
+
+    def _finish(self):
+        if self._alert is not None:
+            self._activity.remove_alert(self._alert)
+            self._alert = None
+
+        alert = NotifyAlert(5)
+        if self._failed:
+            alert.props.title = _('Export failed')
+            alert.props.msg = _('%d of the copies could not be saved.') % \
+                self._failed
+        else:
+            alert.props.title = _('Export done')
+            alert.props.msg = _('The copy is in the Journal.')
+        alert.connect('response',
+                      lambda alert, response_id:
+                      self._activity.remove_alert(alert))
+        self._activity.add_alert(alert)
+        self._failed = 0
 
 
 class DocumentView(Abi.Widget):
 
+    # Abi.Widget methods that change the document, wrapped below so that
+    # they invalidate the content snapshots
+    _MUTATING_METHODS = ('load_file', 'cut', 'paste', 'paste_special',
+                         'undo', 'redo', 'insert_image', 'insert_table',
+                         'invoke', 'invoke_ex', 'set_style', 'set_font_name',
+                         'set_font_size', 'set_text_color', 'toggle_bold',
+                         'toggle_italic', 'toggle_underline', 'toggle_super',
+                         'toggle_sub', 'align_left', 'align_center',
+                         'align_right', 'align_justify')
+
     def __init__(self):
         Abi.init([])
         Abi.Widget.__init__(self)
         self.connect('size-allocate', self.__size_allocate_cb)
+
+        # Exported content of the document by mime type, only kept while
+        # AbiWord reports the document as clean
+        self._revision = 0
+        self._snapshots = {}
+        self._snapshots_enabled = True
+        self.connect('key-press-event', self.__edit_event_cb)
+        self.connect('button-release-event', self.__edit_event_cb)
+        self.connect('drag-data-received', self.__edit_event_cb)
+        for signal in ('can-undo', 'can-redo'):
+            try:
+                self.connect(signal, self.__edit_event_cb)
+            except TypeError:
+                logging.debug('EXCEPTION: %s signal not available', signal)
+        # AbiWord's own dirty flag, None while unknown
+        self._dirty = None
+        self._tracks_dirty = False
+        try:
+            self.connect('is-dirty', self.__is_dirty_cb)
+            self._tracks_dirty = True
+        except TypeError:
+            logging.debug('EXCEPTION: is-dirty signal not available')
+
         try:
             self.connect('request-clear-area', self.__request_clear_area_cb)
         except:
@@ -269,7 +412,82 @@ class DocumentView(Abi.Widget):
         self.queue_resize()
         return True
 
+    def __edit_event_cb(self, widget, *args):
+        self.invalidate_snapshots()
+        return False
+
+    def __is_dirty_cb(self, widget, dirty):
+        self._dirty = dirty
+        # saving makes the document clean without changing it
+        if dirty:
+            self.invalidate_snapshots()
+
+    def is_known_clean(self):
+        """
+        True only if AbiWord reported the document as unmodified since it
+        was last saved. Unlike the revision, this also covers edits that
+        come without key or mouse events (input methods, spell checking).
+        """
+        return self._tracks_dirty and self._dirty is False
+
+    def invalidate_snapshots(self):
+        """
+        Forget the cached content, the document has (or may have) changed.
+        """
+        self._revision += 1
+        self._snapshots.clear()
+
+    def get_revision(self):
+        """
+        Number that changes whenever the document may have changed.
+        """
+        return self._revision
+
+    def set_snapshots_enabled(self, enabled):
+        """
+        Caching relies on local edit events, disable it when the document
+        can also be changed by others (shared activity).
+        """
+        self._snapshots_enabled = enabled
+        self.invalidate_snapshots()
+
+    def get_snapshots_enabled(self):
+        return self._snapshots_enabled
+
+    def get_content_snapshot(self, mime_type='text/plain'):
+        """
+        Document content exported as mime_type, like get_content, but
+        exported only once while the document is known to be clean.
+
+        Edits can come without any event we see, but the first one makes
+        AbiWord report the document dirty, so nothing stale is returned.
+        """
+        if not self._snapshots_enabled or not self.is_known_clean():
+            return self.get_content(mime_type, None)[0]
+        if mime_type not in self._snapshots:
+            self._snapshots[mime_type] = self.get_content(mime_type, None)[0]
+        return self._snapshots[mime_type]
+
     def get_version(self):
         version = Abi._version
         logging.debug('Abiword version %s', version)
         return version
+
+
+def _changes_document(name):
+    method = getattr(Abi.Widget, name)
+
+    def wrapper(self, *args):
+        try:
+            return method(self, *args)
+        finally:
+            self.invalidate_snapshots()
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in DocumentView._MUTATING_METHODS:
+    if hasattr(Abi.Widget, _name):
+        setattr(DocumentView, _name, _changes_document(_name))